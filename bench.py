@@ -0,0 +1,240 @@
+"""Benchmark each translation tier using the sentences in mem.txt as the workload
+
+    python bench.py --output results.json
+    python bench.py --scales 1,100,1000 --rule-counts 28,1000,10000 --no-model
+
+Memory is scaled synthetically by repeating mem.txt with unique suffixes and
+the rule tables by adding generated phrases. The model tiers use a tiny
+randomly initialised T5 model built locally from mem.txt, so the suite runs
+offline. --backend picks the inference backend and --parity checks its
+outputs against eager fp32 on the same sentences. Results are printed as a
+table and, with --output, written as JSON for comparison between runs.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import cascade
+import memory_index
+from memory import MEM_FILE, TranslationMemory
+from models import BACKENDS, DECODING_PROFILES, PREFIXES, check_parity, generate_t5, load_pipeline, load_t5, run_pipeline
+from rules import PhraseRules, translation_rules
+
+
+def read_pairs(path):
+    pairs = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.strip().split('|||')
+            if len(parts) == 3:
+                pairs.append(tuple(parts))
+    return pairs
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(func, items, repeat=1):
+    """Time func over every item, returning latency percentiles in ms and ops per second"""
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            t0 = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - t0)
+    total = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "n": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "throughput_per_s": len(latencies) / total if total else 0.0,
+    }
+
+
+def write_scaled_memory(pairs, scale, path):
+    """Write scale copies of pairs, each copy's sources made unique"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for copy in range(scale):
+            suffix = f" {copy}" if copy else ""
+            for direction, src, tgt in pairs:
+                f.write(f"{direction}|||{src}{suffix}|||{tgt}\n")
+
+
+def scaled_rules(direction, count, seed=0):
+    """The real rule table padded with generated phrases up to count entries"""
+    rng = random.Random(seed)
+    rules = dict(translation_rules[direction])
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    while len(rules) < count:
+        words = ["".join(rng.choice(letters) for _ in range(rng.randint(3, 8)))
+                 for _ in range(rng.randint(1, 4))]
+        rules[" ".join(words)] = "x"
+    return PhraseRules(rules)
+
+
+def perturb(text, rng):
+    """Drop one character so the text misses the exact memory key"""
+    if len(text) < 4:
+        return text
+    i = rng.randrange(len(text))
+    return text[:i] + text[i + 1:]
+
+
+def build_tiny_model(path, corpus, seed=0):
+    """Save a tiny random T5 model and tokenizer trained on corpus to path"""
+    import sentencepiece as spm
+    import torch
+    from transformers import T5Config, T5ForConditionalGeneration, T5Tokenizer
+
+    os.makedirs(path, exist_ok=True)
+    corpus_file = os.path.join(path, "corpus.txt")
+    with open(corpus_file, 'w', encoding='utf-8') as f:
+        f.write("\n".join(corpus) + "\n")
+    spm.SentencePieceTrainer.train(
+        input=corpus_file, model_prefix=os.path.join(path, "spiece"),
+        vocab_size=200, hard_vocab_limit=False, model_type="unigram",
+        pad_id=0, eos_id=1, unk_id=2, bos_id=-1
+    )
+    tokenizer = T5Tokenizer(os.path.join(path, "spiece.model"))
+    torch.manual_seed(seed)
+    config = T5Config(
+        vocab_size=len(tokenizer), d_model=32, d_kv=8, d_ff=64, num_layers=2,
+        num_decoder_layers=2, num_heads=4, decoder_start_token_id=0,
+        pad_token_id=0, eos_token_id=1
+    )
+    T5ForConditionalGeneration(config).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return path
+
+
+def bench_memory(pairs, scales, workdir, repeat):
+    rng = random.Random(0)
+    results = {}
+    for scale in scales:
+        path = os.path.join(workdir, f"mem_x{scale}.txt")
+        write_scaled_memory(pairs, scale, path)
+        load_log = measure(lambda p: TranslationMemory(p), [path])
+        memory_index.build(path)
+        load_indexed = measure(lambda p: TranslationMemory(p), [path])
+        memory = TranslationMemory(path)
+        lookups = [(d, s) for d, s, _ in pairs]
+        near = [(d, perturb(s, rng)) for d, s, _ in pairs]
+        # Two stored sources run together, which only composition can resolve
+        joined = [(d, f"{s} {pairs[(i + 1) % len(pairs)][1]}") for i, (d, s, _) in enumerate(pairs)]
+        results[f"x{scale}"] = {
+            "entries": len(memory),
+            "load_memory": load_log,
+            "load_memory_indexed": load_indexed,
+            # Fuzzy, phrase and search structures, which the lookups below need
+            "warm_memory": measure(lambda m: m.warm(), [memory]),
+            "memory_hit": measure(lambda k: memory.get(*k), lookups, repeat),
+            "fuzzy_memory": measure(lambda k: memory.fuzzy_get(*k), near, repeat),
+            "composed_memory": measure(lambda k: cascade.compose(k[0], k[1], memory), joined, repeat),
+        }
+    return results
+
+
+def bench_rules(pairs, rule_counts, repeat):
+    results = {}
+    for count in rule_counts:
+        engines = {d: scaled_rules(d, count) for d in translation_rules}
+        results[str(count)] = measure(lambda p: engines[p[0]].apply(p[1]), pairs, repeat)
+    return results
+
+
+def bench_models(pairs, model_dir, repeat, backend, profile):
+    texts = [(d, s) for d, s, _ in pairs]
+    memory = TranslationMemory(os.devnull)
+    pipe = load_pipeline(model_dir, backend)
+    tokenizer, model = load_t5(model_dir, backend)
+    model_fn = lambda batch: run_pipeline(pipe, batch, profile)
+    return {
+        "cascade_model": measure(
+            lambda p: cascade.translate(p[0], p[1], memory, model_fn), texts, repeat),
+        "pipeline": measure(lambda p: model_fn([p[1]]), texts, repeat),
+        "sc_translate": measure(
+            lambda p: generate_t5(tokenizer, model, PREFIXES[p[0]], [p[1]], profile),
+            texts, repeat),
+        "sc_translate_batch": measure(
+            lambda batch: generate_t5(tokenizer, model, PREFIXES[batch[0][0]],
+                                      [s for _, s in batch], profile),
+            [texts[i:i + 16] for i in range(0, len(texts), 16)], repeat),
+    }
+
+
+def print_table(results, prefix=""):
+    for name, value in results.items():
+        if isinstance(value, dict) and "p50_ms" in value:
+            print(f"{prefix + name:<40} p50 {value['p50_ms']:9.3f} ms  p95 {value['p95_ms']:9.3f} ms"
+                  f"  p99 {value['p99_ms']:9.3f} ms  {value['throughput_per_s']:10.1f}/s")
+        elif isinstance(value, dict):
+            print_table(value, prefix + name + ".")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--memory", default=MEM_FILE)
+    parser.add_argument("--scales", default="1,10,100",
+                        help="comma-separated memory size multipliers")
+    parser.add_argument("--rule-counts", default="28,1000,10000",
+                        help="comma-separated rule table sizes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--model-dir", help="existing local model to use instead of the tiny one")
+    parser.add_argument("--no-model", action="store_true", help="skip the model tiers")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager",
+                        help="inference backend for the model tiers")
+    parser.add_argument("--profile", choices=DECODING_PROFILES, default="quality",
+                        help="decoding profile for the model tiers")
+    parser.add_argument("--parity", action="store_true",
+                        help="also compare the backend's outputs against eager fp32")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    pairs = read_pairs(args.memory)
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "workload_pairs": len(pairs),
+            "repeat": args.repeat,
+            "backend": args.backend,
+            "profile": args.profile,
+        }
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        results["memory"] = bench_memory(
+            pairs, [int(s) for s in args.scales.split(",")], workdir, args.repeat)
+        results["rules"] = bench_rules(
+            [(d, s) for d, s, _ in pairs],
+            [int(c) for c in args.rule_counts.split(",")], args.repeat)
+        if not args.no_model:
+            model_dir = args.model_dir or build_tiny_model(
+                os.path.join(workdir, "tiny-t5"), [s for _, s, _ in pairs] + [t for _, _, t in pairs])
+            results["model"] = bench_models(pairs, model_dir, args.repeat, args.backend, args.profile)
+            if args.parity:
+                match_rate, diffs = check_parity(
+                    model_dir, args.backend, [s for _, s, _ in pairs], profile=args.profile)
+                results["parity"] = {"match_rate": match_rate, "diffs": diffs}
+                print(f"{args.backend} parity with fp32: {match_rate:.1%} identical outputs")
+
+    print_table({k: v for k, v in results.items() if k not in ("meta", "parity")})
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import os
+import re
+
+import metrics
+from rules import TOKEN_RE, rule_engines
+
+# Sentence and clause boundaries, kept so the output can be reassembled
+BOUNDARY_RE = re.compile(r"([.!?;,]+\s*|\n+\s*)")
+
+# Composition is only used when stored phrases cover at least this share of a segment's words
+COMPOSE_MIN_COVERAGE = float(os.environ.get("PIDEN_COMPOSE_MIN_COVERAGE", "0.5"))
+
+
+# The tiers a caller can leave out or restrict the cascade to; the memory
+# tier includes fuzzy and composed matches
+TIERS = frozenset({"memory", "rule-based", "model-based"})
+
+# Tiers each force_method leaves out
+FORCE_SKIPS = {
+    None: frozenset(),
+    "memory": frozenset({"memory"}),
+    "rule-based": frozenset({"model-based"}),
+    "model-based": frozenset({"rule-based"}),
+}
+
+
+def skipped_tiers(force_method=None, only=None):
+    """The tiers to leave out for a force_method, or all but only if it is given"""
+    if only is not None:
+        return TIERS - {only}
+    return FORCE_SKIPS[force_method]
+
+
+def split_segments(text):
+    """Split text into (lead, segment, trail) triples that join back to the original"""
+    parts = BOUNDARY_RE.split(text)
+    segments = []
+    for i in range(0, len(parts), 2):
+        part = parts[i]
+        sep = parts[i + 1] if i + 1 < len(parts) else ""
+        core = part.strip()
+        if not core:
+            if segments:
+                lead, seg, trail = segments[-1]
+                segments[-1] = (lead, seg, trail + part + sep)
+            else:
+                segments.append((part + sep, "", ""))
+            continue
+        lead = part[:len(part) - len(part.lstrip())]
+        trail = part[len(part.rstrip()):]
+        segments.append((lead, core, trail + sep))
+    return segments
+
+
+def record(tier, hit):
+    metrics.TIER_LOOKUPS.inc(tier=tier, result="hit" if hit else "miss")
+    return hit
+
+
+def resolve(direction, text, memory, skip=frozenset()):
+    """Translate text from memory or rules, returning (None, None) when the model is needed"""
+    # Check memory first unless it is skipped
+    if "memory" not in skip:
+        with metrics.TIER_LATENCY.time(tier="memory"):
+            mem_translation = memory.get(direction, text)
+        if record("memory", mem_translation is not None):
+            return mem_translation, "memory"
+        # Near-duplicates of stored sentences are still cheaper than the model
+        with metrics.TIER_LATENCY.time(tier="fuzzy-memory"):
+            mem_translation = memory.fuzzy_get(direction, text)
+        if record("fuzzy-memory", mem_translation is not None):
+            return mem_translation, "fuzzy-memory"
+
+    # Apply rules unless they are skipped
+    if "rule-based" not in skip:
+        rule_translation = apply_rules(direction, text)
+        if rule_translation is not None:
+            return rule_translation, "rule-based"
+
+    return None, None
+
+
+def apply_rules(direction, text):
+    """Rule-based translation of text, or None if no rule fired"""
+    with metrics.TIER_LATENCY.time(tier="rule-based"):
+        rule_translation, fired = rule_engines[direction].apply(text)
+    return rule_translation if record("rule-based", fired) else None
+
+
+def compose(direction, text, memory, min_coverage=COMPOSE_MIN_COVERAGE):
+    """Cover text with the longest stored memory sources it contains
+
+    Returns a list of (source, translation, method) pieces in order, with
+    None as the translation of spans no stored source covers, or None if
+    the stored sources cover too little of text.
+    """
+    with metrics.TIER_LATENCY.time(tier="composed"):
+        matches = memory.phrase_matches(direction, text)
+        pieces = []
+        covered = 0
+        last = 0
+        for start, end, _, tgt in matches:
+            gap = text[last:start].strip()
+            if gap:
+                pieces.append((gap, None, None))
+            pieces.append((text[start:end], tgt, "composed"))
+            covered += len(TOKEN_RE.findall(text[start:end]))
+            last = end
+        gap = text[last:].strip()
+        if gap:
+            pieces.append((gap, None, None))
+    total = len(TOKEN_RE.findall(text))
+    if record("composed", bool(matches) and covered >= min_coverage * total):
+        return pieces
+    return None
+
+
+def coverage(segments):
+    """Share of source words translated without the model, from translate's segments"""
+    total = covered = 0
+    for src, _, method in segments:
+        words = len(TOKEN_RE.findall(src))
+        total += words
+        if method not in ("model-based", "none"):
+            covered += words
+    return covered / total if total else 0.0
+
+
+def translate(direction, text, memory, model, force_method=None, only=None):
+    """Memory -> memory phrases -> rules -> model cascade applied per segment
+
+    model takes a list of texts and returns their translations; every
+    segment that memory and rules cannot resolve goes to it in one call.
+    Returns the reassembled translation, the overall method and a list of
+    (source, translation, method) per segment.
+
+    force_method leaves a tier out: "memory" skips it, "rule-based" skips
+    the model and "model-based" skips the rules. only, instead, uses that
+    one tier alone.
+    """
+    return translate_many(direction, [text], memory, model, force_method, only)[0]
+
+
+def translate_many(direction, texts, memory, model, force_method=None, only=None):
+    """Run the cascade over several texts with a single model call for all their misses"""
+    skip = skipped_tiers(force_method, only)
+    plans = []
+    pending = []
+    for text in texts:
+        # A stored translation of the whole input wins over its pieces
+        whole = resolve(direction, text, memory, skip)
+        if whole[0] is not None and whole[1] != "rule-based":
+            plans.append((None, [(text, *whole)]))
+            continue
+
+        segments = split_segments(text)
+        results = []
+        for seg_index, (_, seg, _) in enumerate(segments):
+            if not seg:
+                results.append((seg, seg, None))
+                continue
+            if seg == text:
+                # The whole input is one segment, already resolved above
+                translated, method = whole
+            else:
+                translated, method = resolve(direction, seg, memory, skip)
+            pieces = None
+            # Stored phrases are preferred to rules, which leave unmatched words untranslated
+            if method in (None, "rule-based") and "memory" not in skip:
+                pieces = compose(direction, seg, memory)
+            if pieces is not None:
+                # Stitch stored phrases together; gaps go through the rules,
+                # then the model
+                for k, (src, tgt, _) in enumerate(pieces):
+                    if tgt is not None:
+                        continue
+                    if "rule-based" not in skip:
+                        rule_translation = apply_rules(direction, src)
+                        if rule_translation is not None:
+                            pieces[k] = (src, rule_translation, "rule-based")
+                            continue
+                    if "model-based" not in skip:
+                        pending.append((len(plans), seg_index, k))
+                results.append((seg, pieces, "composed"))
+                continue
+            if translated is None:
+                # Use the model unless it is skipped
+                if "model-based" not in skip:
+                    pending.append((len(plans), seg_index, None))
+                translated, method = seg, "none"
+            results.append((seg, translated, method))
+        plans.append((segments, results))
+
+    if pending:
+        with metrics.TIER_LATENCY.time(tier="model-based"):
+            outputs = model([
+                plans[i][0][j][1] if k is None else plans[i][1][j][1][k][0]
+                for i, j, k in pending
+            ])
+        metrics.TIER_LOOKUPS.inc(len(pending), tier="model-based", result="hit")
+        for (i, j, k), output in zip(pending, outputs):
+            if k is None:
+                plans[i][1][j] = (plans[i][0][j][1], output, "model-based")
+            else:
+                pieces = plans[i][1][j][1]
+                pieces[k] = (pieces[k][0], output, "model-based")
+
+    return [assemble(segments, results) for segments, results in plans]
+
+
+def assemble(segments, results):
+    if segments is None:
+        return results[0][1], results[0][2], results
+    pieces = []
+    flat = []
+    for (lead, _, trail), (seg, translated, method) in zip(segments, results):
+        if isinstance(translated, list):
+            # A composed segment is reported piece by piece
+            parts = [(src, src if tgt is None else tgt, part_method or "none")
+                     for src, tgt, part_method in translated]
+            translated = " ".join(tgt for _, tgt, _ in parts)
+            flat.extend(parts)
+        elif method is not None:
+            flat.append((seg, translated, method))
+        pieces.append(lead + translated + trail)
+    results = flat
+    methods = {r[2] for r in results}
+    if len(methods) == 1:
+        method = methods.pop()
+    else:
+        method = "mixed" if methods else "none"
+    return "".join(pieces), method, results
@@ -0,0 +1,147 @@
+"""Translate files from the command line with the same memory -> rules -> model cascade
+
+    python cli.py sentences.txt -o out.txt --direction pidgin_to_english
+    python cli.py mem.txt -o out.txt --format mem --workers 4 --resume
+
+Output lines use the mem.txt format (direction|||source|||translation) and
+are written in input order as each batch finishes, so an interrupted job
+can be continued with --resume.
+"""
+import argparse
+import collections
+import itertools
+import multiprocessing
+import os
+import sys
+
+from core import Translator
+from memory import MEM_FILE
+from models import DECODING_PROFILES, MODEL_IDS
+
+DIRECTIONS = tuple(MODEL_IDS)
+
+# Per-process state, set up once in each worker
+worker = {}
+
+
+def init_worker(memory_path, use_model, profile):
+    # Each worker runs its own batches, so the cross-thread scheduler is not needed
+    worker["translator"] = Translator(memory_path=memory_path, batching=False)
+    # Every line gets the fuzzy and phrase tiers, not just those after they are built
+    worker["translator"].memory.warm()
+    worker["force_method"] = None if use_model else "rule-based"
+    worker["profile"] = profile
+
+
+def translate_chunk(chunk):
+    """Translate a list of (direction, source) pairs, one model call per direction"""
+    results = [None] * len(chunk)
+    for direction in DIRECTIONS:
+        indexes = [i for i, (d, _) in enumerate(chunk) if d == direction]
+        if not indexes:
+            continue
+        outputs = worker["translator"].translate_many(
+            direction, [chunk[i][1] for i in indexes],
+            force_method=worker["force_method"], profile=worker["profile"]
+        )
+        for i, (translated, method, _) in zip(indexes, outputs):
+            results[i] = (direction, chunk[i][1], translated, method)
+    return results
+
+
+def read_input(path, fmt, direction):
+    """Yield (direction, source) pairs from a plain or mem.txt-format file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if fmt == "mem":
+                parts = line.split('|||')
+                if len(parts) != 3:
+                    continue
+                yield parts[0], parts[1]
+            else:
+                yield direction, line
+
+
+def chunked(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bounded_imap(pool, func, chunks, window):
+    """Ordered pool.imap that keeps at most window chunks in flight"""
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(func, (chunk,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def complete_lines(path):
+    """Count the newline-terminated lines of path, cutting off a partly written last line"""
+    if not os.path.exists(path):
+        return 0
+    count = end = position = 0
+    with open(path, 'rb+') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            count += block.count(b"\n")
+            if b"\n" in block:
+                end = position + block.rindex(b"\n") + 1
+            position += len(block)
+        # An interrupted write leaves a tail that would be joined to the next line
+        f.truncate(end)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="file with one sentence per line, or mem.txt-format pairs")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--format", choices=("lines", "mem"), default="lines")
+    parser.add_argument("--direction", choices=DIRECTIONS, default="pidgin_to_english",
+                        help="direction for --format lines")
+    parser.add_argument("--memory", default=MEM_FILE, help="translation memory file")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--profile", choices=DECODING_PROFILES, default="quality",
+                        help="decoding profile for the model tier")
+    parser.add_argument("--no-model", action="store_true", help="use memory and rules only")
+    parser.add_argument("--resume", action="store_true", help="skip inputs already in the output")
+    args = parser.parse_args(argv)
+
+    done = complete_lines(args.output) if args.resume else 0
+    items = itertools.islice(read_input(args.input, args.format, args.direction), done, None)
+    chunks = chunked(items, args.batch_size)
+    init_args = (args.memory, not args.no_model, args.profile)
+
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=init_args)
+        results = bounded_imap(pool, translate_chunk, chunks, 2 * args.workers)
+    else:
+        pool = None
+        init_worker(*init_args)
+        results = map(translate_chunk, chunks)
+
+    written = 0
+    try:
+        with open(args.output, 'a' if args.resume else 'w', encoding='utf-8') as out:
+            for chunk in results:
+                for direction, src, translated, _ in chunk:
+                    translated = " ".join(translated.splitlines())
+                    out.write(f"{direction}|||{src}|||{translated}\n")
+                out.flush()
+                written += len(chunk)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    print(f"Translated {written} lines ({done} skipped)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""Translation core shared by the Streamlit apps, the CLI and other services
+
+Only the standard library is imported here; torch and transformers load the
+first time a request actually reaches the model tier, so memory and rule
+lookups start quickly.
+"""
+import os
+
+import cascade
+from memory import MEM_FILE, TranslationMemory
+from model_cache import ModelOutputCache
+from models import (BACKEND, MODEL_IDS, LazyModel, can_stream, load_pipeline,
+                    profile_for_load, run_pipeline, stream_pipeline)
+from scheduler import BatchScheduler
+from speculation import SpeculationSkipped, Speculator
+
+
+class Translator:
+    """Translation memory, rules and lazily loaded models behind the cascade
+
+    With batching on, model calls from every thread go through one
+    BatchScheduler per direction; otherwise each caller runs the model
+    directly, which suits single-threaded batch jobs.
+    """
+
+    def __init__(self, memory_path=MEM_FILE, model_ids=MODEL_IDS, loader=load_pipeline,
+                 cache=None, batching=True, max_batch_size=8, max_wait=0.01, max_queue=256,
+                 timeout=None, speculative_workers=2, speculative_depth=4):
+        self.memory = TranslationMemory(memory_path)
+        self.model_ids = dict(model_ids)
+        self.models = {
+            direction: LazyModel(lambda model_id=model_id: loader(model_id))
+            for direction, model_id in self.model_ids.items()
+        }
+        self.cache = cache if cache is not None else ModelOutputCache()
+        self.timeout = timeout
+        self.schedulers = {}
+        if batching:
+            for direction in self.model_ids:
+                self.schedulers[direction] = BatchScheduler(
+                    lambda texts, profile, background, direction=direction:
+                        self.generate(direction, texts, profile, background),
+                    max_batch_size=max_batch_size, max_wait=max_wait, max_queue=max_queue
+                )
+        # Fallback candidates are only worked on while the model queue is at most this deep
+        self.speculative_depth = speculative_depth
+        self.speculator = Speculator(speculative_workers) if speculative_workers else None
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        """A Translator configured from PIDEN_* environment variables"""
+        env = os.environ
+        # Seconds a caller waits for its turn on the model before giving up
+        kwargs.setdefault("timeout", float(env.get("PIDEN_MODEL_TIMEOUT", "60")))
+        kwargs.setdefault("cache", ModelOutputCache(
+            capacity=int(env.get("PIDEN_MODEL_CACHE_SIZE", "10000")),
+            path=env.get("PIDEN_MODEL_CACHE"),
+            # Callers waiting on another's translation give up at the same point
+            wait_timeout=kwargs["timeout"]
+        ))
+        kwargs.setdefault("max_batch_size", int(env.get("PIDEN_MAX_BATCH_SIZE", "8")))
+        kwargs.setdefault("max_wait", float(env.get("PIDEN_BATCH_WAIT", "0.01")))
+        kwargs.setdefault("max_queue", int(env.get("PIDEN_MAX_QUEUE", "256")))
+        # 0 workers turns speculative fallbacks off
+        kwargs.setdefault("speculative_workers", int(env.get("PIDEN_SPECULATIVE_WORKERS", "2")))
+        kwargs.setdefault("speculative_depth", int(env.get("PIDEN_SPECULATIVE_DEPTH", "4")))
+        return cls(**kwargs)
+
+    def ready(self):
+        """Which directions have loaded their model, even if it was freed since for idling"""
+        return {direction: model.loadable for direction, model in self.models.items()}
+
+    def load_models(self):
+        """Load every direction's model now rather than on first use"""
+        for model in self.models.values():
+            model.get()
+
+    def queue_depth(self, direction):
+        scheduler = self.schedulers.get(direction)
+        return scheduler.depth() if scheduler else 0
+
+    def generate(self, direction, texts, profile, background=False):
+        # Background work does not keep an otherwise idle model loaded
+        return run_pipeline(self.models[direction].get(touch=not background), texts, profile)
+
+    def run_model(self, direction, texts, profile="quality", stream=None, background=False,
+                  queued=None):
+        """Model tier: cached or in-flight outputs first, then one batched (or streamed) model call
+
+        stream, if given, is called with the partial translation while a
+        single greedy translation is decoded. background requests wait
+        behind live ones in the scheduler queue; queued is called with a
+        function promoting the scheduler request to live priority.
+        """
+        # Fall back to cheaper decoding rather than time out when the queue is deep
+        profile = profile_for_load(profile, self.queue_depth(direction))
+
+        def generate(missing):
+            if stream is not None and len(missing) == 1 and can_stream(profile):
+                translated = ""
+                for translated in stream_pipeline(self.models[direction].get(), missing[0], profile):
+                    stream(translated)
+                return [translated]
+            if direction in self.schedulers:
+                scheduler = self.schedulers[direction]
+                on_queued = None
+                if queued is not None:
+                    on_queued = lambda future: queued(lambda: scheduler.promote(future))
+                return scheduler.submit(
+                    missing, profile=profile, timeout=self.timeout, priority=1 if background else 0,
+                    queued=on_queued)
+            return self.generate(direction, missing, profile, background)
+
+        # Outputs differ between backends, e.g. int8 against fp32
+        params = {"profile": profile, "backend": BACKEND}
+        return self.cache.translate(direction, self.model_ids[direction], params, texts, generate)
+
+    def translate(self, direction, text, memory=None, force_method=None, profile="quality",
+                  stream=None, only=None):
+        """Run the cascade over text, returning (translation, method, segments)"""
+        return self.translate_many(direction, [text], memory, force_method, profile, stream, only)[0]
+
+    def translate_many(self, direction, texts, memory=None, force_method=None, profile="quality",
+                       stream=None, only=None):
+        """Run the cascade over several texts with one model call for all their misses
+
+        memory defaults to the shared store; pass a SessionMemory to include
+        a session's own approvals. force_method and only are as in
+        cascade.translate.
+        """
+        return cascade.translate_many(
+            direction, texts, memory if memory is not None else self.memory,
+            lambda missing: self.run_model(direction, missing, profile, stream),
+            force_method=force_method, only=only
+        )
+
+    def speculate(self, direction, text, memory=None, methods=(), profile="quality"):
+        """Start translating text with only each of methods in the background
+
+        Returns a Speculation whose result(method) is the
+        (translation, method, segments) the cascade would give, or None if
+        speculation is off or had to give way to live requests. Speculation
+        never loads a model: candidates needing one that is not loaded are
+        skipped.
+        """
+        if self.speculator is None or self.queue_depth(direction) > self.speculative_depth:
+            return None
+        memory = memory if memory is not None else self.memory
+
+        def job(method):
+            def run(speculation):
+                def model(missing):
+                    # Checked again here since only the model tier is expensive;
+                    # a candidate the user is waiting for runs however deep the queue
+                    wanted = speculation.is_wanted(method)
+                    if (speculation.cancelled.is_set()
+                            or not self.models[direction].loaded
+                            or not wanted and self.queue_depth(direction) > self.speculative_depth):
+                        raise SpeculationSkipped()
+                    return self.run_model(
+                        direction, missing, profile, background=not wanted,
+                        queued=lambda promote: speculation.track(method, promote))
+                return cascade.translate(direction, text, memory, model, only=method)
+            return run
+
+        return self.speculator.start({method: job(method) for method in methods})
@@ -0,0 +1,237 @@
+"""Score translation tiers and decoding profiles against the pairs in mem.txt
+
+    python evaluation.py --configs rules,model:fast,model:quality --workers 4
+    python evaluation.py --configs cascade:balanced,model:balanced --backend int8 --output report.json
+
+A configuration is a tier (rules, model or cascade, i.e. rules then the
+model) with an optional decoding profile. Every source in mem.txt is
+translated with an empty translation memory, so stored pairs cannot just be
+looked up, and scored against its stored translation with corpus-level chrF
+and BLEU. Each configuration runs on a fresh pool of worker processes, which
+also gives its peak memory.
+"""
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import sys
+import time
+
+from bench import read_pairs
+from core import Translator
+from memory import MEM_FILE
+from model_cache import ModelOutputCache
+from models import BACKENDS, DECODING_PROFILES, load_pipeline
+
+TIERS = ("rules", "model", "cascade")
+BLEU_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+# Per-process state, set up once in each worker
+worker = {}
+
+
+def ngrams(items, n):
+    return collections.Counter(tuple(items[i:i + n]) for i in range(len(items) - n + 1))
+
+
+def chrf(hypotheses, references, order=6, beta=2):
+    """Corpus chrF: character n-gram F-score, recall weighted beta times precision"""
+    matches = [0] * order
+    hyp_total = [0] * order
+    ref_total = [0] * order
+    for hyp, ref in zip(hypotheses, references):
+        # Spaces are ignored, as in the original metric
+        hyp, ref = hyp.replace(" ", ""), ref.replace(" ", "")
+        for n in range(1, order + 1):
+            hyp_grams, ref_grams = ngrams(hyp, n), ngrams(ref, n)
+            matches[n - 1] += sum((hyp_grams & ref_grams).values())
+            hyp_total[n - 1] += sum(hyp_grams.values())
+            ref_total[n - 1] += sum(ref_grams.values())
+    precision = sum(m / t for m, t in zip(matches, hyp_total) if t) / order
+    recall = sum(m / t for m, t in zip(matches, ref_total) if t) / order
+    if not precision and not recall:
+        return 0.0
+    return 100 * (1 + beta ** 2) * precision * recall / (beta ** 2 * precision + recall)
+
+
+def bleu(hypotheses, references, order=4):
+    """Corpus BLEU with a brevity penalty, on word and punctuation tokens"""
+    matches = [0] * order
+    totals = [0] * order
+    hyp_length = ref_length = 0
+    for hyp, ref in zip(hypotheses, references):
+        hyp, ref = BLEU_TOKEN_RE.findall(hyp), BLEU_TOKEN_RE.findall(ref)
+        hyp_length += len(hyp)
+        ref_length += len(ref)
+        for n in range(1, order + 1):
+            hyp_grams = ngrams(hyp, n)
+            matches[n - 1] += sum((hyp_grams & ngrams(ref, n)).values())
+            totals[n - 1] += sum(hyp_grams.values())
+    if not hyp_length or not all(matches):
+        return 0.0
+    log_precision = sum(math.log(m / t) for m, t in zip(matches, totals)) / order
+    brevity = min(0.0, 1 - ref_length / hyp_length)
+    return 100 * math.exp(brevity + log_precision)
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes elsewhere
+    return usage / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def parse_config(spec):
+    """(tier, profile) from a "tier[:profile]" string"""
+    tier, _, profile = spec.partition(":")
+    profile = profile or "quality"
+    if tier not in TIERS:
+        raise ValueError(f"Unknown tier {tier!r}, expected one of {TIERS}")
+    if profile not in DECODING_PROFILES:
+        raise ValueError(f"Unknown decoding profile {profile!r}")
+    return tier, profile
+
+
+def init_worker(tier, profile, backend):
+    worker["translator"] = Translator(
+        memory_path=os.devnull,
+        loader=lambda model_id: load_pipeline(model_id, backend),
+        # Every pair is scored on a fresh translation
+        cache=ModelOutputCache(capacity=0),
+        batching=False, speculative_workers=0
+    )
+    worker["tier"] = tier
+    worker["profile"] = profile
+    worker["error"] = None
+    if tier != "rules":
+        try:
+            # Loaded up front so it does not count against throughput
+            worker["translator"].load_models()
+        except Exception as e:
+            # Pool respawns workers whose initializer fails forever, so fail the first chunk instead
+            worker["error"] = e
+
+
+def translate_chunk(chunk):
+    """Translate a (direction, sources) chunk, returning outputs, busy seconds, pid and peak RSS"""
+    if worker["error"] is not None:
+        raise worker["error"]
+    direction, sources = chunk
+    translator = worker["translator"]
+    start = time.perf_counter()
+    if worker["tier"] == "model":
+        outputs = translator.run_model(direction, sources, worker["profile"])
+    else:
+        force_method = "rule-based" if worker["tier"] == "rules" else None
+        outputs = [translated for translated, _, _ in translator.translate_many(
+            direction, sources, force_method=force_method, profile=worker["profile"])]
+    return outputs, time.perf_counter() - start, os.getpid(), peak_rss_mb()
+
+
+def chunked_by_direction(pairs, size):
+    """(direction, indexes) chunks of at most size pairs sharing a direction"""
+    by_direction = collections.defaultdict(list)
+    for i, (direction, _, _) in enumerate(pairs):
+        by_direction[direction].append(i)
+    for direction, indexes in by_direction.items():
+        for start in range(0, len(indexes), size):
+            yield direction, indexes[start:start + size]
+
+
+def scores(pairs, outputs, indexes):
+    hypotheses = [outputs[i] for i in indexes]
+    references = [pairs[i][2] for i in indexes]
+    return {
+        "pairs": len(indexes),
+        "chrf": chrf(hypotheses, references),
+        "bleu": bleu(hypotheses, references),
+        "exact": sum(h.strip() == r.strip() for h, r in zip(hypotheses, references)) / len(indexes)
+        if indexes else 0.0,
+    }
+
+
+def evaluate(pairs, tier, profile, workers, batch_size, backend):
+    chunks = list(chunked_by_direction(pairs, batch_size))
+    outputs = [None] * len(pairs)
+    busy = collections.Counter()
+    peak = 0.0
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers, initializer=init_worker,
+                              initargs=(tier, profile, backend)) as pool:
+        results = pool.map(translate_chunk,
+                           [(d, [pairs[i][1] for i in indexes]) for d, indexes in chunks], 1)
+    wall = time.perf_counter() - start
+    for (_, indexes), (chunk_outputs, seconds, pid, rss) in zip(chunks, results):
+        for i, output in zip(indexes, chunk_outputs):
+            outputs[i] = output
+        busy[pid] += seconds
+        peak = max(peak, rss)
+
+    # The busiest worker bounds throughput once the models are loaded
+    elapsed = max(busy.values()) if busy else 0.0
+    result = scores(pairs, outputs, range(len(pairs)))
+    result.update({
+        "sentences_per_s": len(pairs) / elapsed if elapsed else 0.0,
+        "wall_s": wall,
+        "peak_rss_mb": peak,
+        "directions": {
+            direction: scores(pairs, outputs, [i for i, p in enumerate(pairs) if p[0] == direction])
+            for direction in sorted({p[0] for p in pairs})
+        },
+        "samples": [
+            {"source": pairs[i][1], "reference": pairs[i][2], "output": outputs[i]}
+            for i in range(min(5, len(pairs)))
+        ],
+    })
+    return result
+
+
+def print_report(results):
+    print(f"{'config':<20} {'chrF':>7} {'BLEU':>7} {'exact':>7} {'sent/s':>10} {'peak MB':>9}")
+    for name, result in results.items():
+        print(f"{name:<20} {result['chrf']:7.2f} {result['bleu']:7.2f} {result['exact']:7.1%}"
+              f" {result['sentences_per_s']:10.1f} {result['peak_rss_mb']:9.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--memory", default=MEM_FILE, help="pairs to evaluate against")
+    parser.add_argument("--configs", default="rules,model:fast,model:balanced,model:quality",
+                        help="comma-separated tier[:profile] configurations to compare")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager",
+                        help="inference backend for the model tier")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    pairs = read_pairs(args.memory)
+    configs = {spec: parse_config(spec) for spec in args.configs.split(",")}
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "pairs": len(pairs),
+            "workers": args.workers,
+            "batch_size": args.batch_size,
+            "backend": args.backend,
+        },
+        "results": {},
+    }
+    for name, (tier, profile) in configs.items():
+        print(f"Evaluating {name}...", file=sys.stderr)
+        report["results"][name] = evaluate(pairs, tier, profile, args.workers, args.batch_size, args.backend)
+
+    print_report(report["results"])
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Report written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,686 @@
+import array
+import atexit
+import bisect
+import itertools
+import math
+import os
+import re
+import threading
+import time
+
+import metrics
+from rules import PhraseRules
+
+try:
+    import fcntl
+except ImportError:  # Windows: writes are still batched, just not locked
+    fcntl = None
+
+# Memory system
+MEM_FILE = "mem.txt"
+
+# Approvals are written in groups, at least this often or once this many are queued
+FLUSH_INTERVAL = float(os.environ.get("PIDEN_MEMORY_FLUSH_INTERVAL", "0.5"))
+FLUSH_SIZE = int(os.environ.get("PIDEN_MEMORY_FLUSH_SIZE", "64"))
+# A lookup miss re-reads the log for other processes' approvals at most this often
+REFRESH_INTERVAL = float(os.environ.get("PIDEN_MEMORY_REFRESH_INTERVAL", "1.0"))
+
+SPACE_RE = re.compile(r"\s+")
+TRAILING_PUNCT_RE = re.compile(r"[\s.,!?;:…]+$")
+WORD_RE = re.compile(r"[\w'’]+")
+
+# Words that flip a sentence's meaning, in Pidgin and English, so fuzzy
+# matches must agree on them however similar the rest is
+NEGATIONS = frozenset({"no", "not", "never", "neva", "nor", "nothing", "nobody", "none",
+                       "cannot", "without"})
+
+
+def normalize(text):
+    """Memory key for a source string: case, spacing and trailing punctuation ignored"""
+    text = SPACE_RE.sub(" ", text.strip()).casefold()
+    return TRAILING_PUNCT_RE.sub("", text)
+
+
+def check_pair(src_text, tgt_text):
+    """Raise ValueError unless the pair fits on one direction|||source|||translation line"""
+    for name, text in (("source", src_text), ("translation", tgt_text)):
+        if not isinstance(text, str):
+            raise ValueError(f"{name} must be a string")
+        if "\n" in text or "\r" in text or "|||" in text:
+            raise ValueError(f"{name} must not contain line breaks or '|||'")
+
+
+def file_id(path):
+    """(device, inode) of path, which changes when the file is replaced"""
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+def open_locked(path):
+    """Open the log for appending, holding the exclusive lock every writer takes
+
+    A log replaced while waiting for the lock, e.g. by compaction, is
+    reopened so nothing is appended to the old file.
+    """
+    while True:
+        f = open(path, 'ab')
+        if fcntl is None:
+            return f
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            st = os.fstat(f.fileno())
+            if (st.st_dev, st.st_ino) == file_id(path):
+                return f
+        except FileNotFoundError:
+            pass
+        # Closing releases the lock
+        f.close()
+
+
+def negations(key):
+    """The negating words of a normalized source, sorted so repeats are compared too"""
+    words = [word for word in WORD_RE.findall(key)
+             if word in NEGATIONS or word.endswith(("n't", "n’t"))]
+    return sorted(words)
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """Character-trigram index over memory sources for approximate lookup"""
+
+    def __init__(self, max_candidates=200):
+        self.max_candidates = max_candidates
+        self.keys = []
+        self.ids = {}
+        self.postings = {}
+
+    def add(self, key):
+        if key in self.ids:
+            return
+        key_id = len(self.keys)
+        self.keys.append(key)
+        self.ids[key] = key_id
+        for gram in trigrams(key):
+            self.postings.setdefault(gram, []).append(key_id)
+
+    def search(self, key, threshold, accept=None):
+        """Return (similarity, key) of the closest source with Dice similarity >= threshold
+
+        accept, if given, is called with each candidate key and can veto it.
+        """
+        grams = trigrams(key)
+        # A match shares at least this many trigrams with the query, so it
+        # must appear in one of the rarest len(grams) - needed + 1 postings
+        needed = math.ceil(threshold * len(grams) / (2 - threshold))
+        probe = sorted(grams, key=lambda g: len(self.postings.get(g, ())))
+        counts = {}
+        for gram in probe[:len(grams) - needed + 1]:
+            for key_id in self.postings.get(gram, ()):
+                counts[key_id] = counts.get(key_id, 0) + 1
+        # Bound the verification work on very common queries
+        candidates = sorted(counts, key=counts.get, reverse=True)[:self.max_candidates]
+        best = None
+        for key_id in candidates:
+            other = trigrams(self.keys[key_id])
+            score = 2 * len(grams & other) / (len(grams) + len(other))
+            if score >= threshold and (best is None or score > best[0]):
+                if accept is not None and not accept(self.keys[key_id]):
+                    continue
+                best = (score, self.keys[key_id])
+        return best
+
+
+class MemorySearch:
+    """Prefix and substring search over normalized memory sources and targets
+
+    Prefix queries bisect a sorted list of "text\x00direction\x00key"
+    strings. Substring queries search one UTF-8 blob of every entry
+    backwards with bytes.rfind, newest first, so both stop as soon as a
+    page is full. Entries changed after the blob was built are kept in a
+    short list searched before it, which is folded back into the blob
+    once it holds fold_at entries.
+    """
+
+    def __init__(self, items=(), fold_at=1024):
+        """Index items, an iterable of ((direction, key), tgt) in approval order"""
+        self.fold_at = fold_at
+        self.targets = {}
+        self.sorted = []
+        entries = []
+        for entry, tgt in items:
+            target = normalize(tgt)
+            self.targets[entry] = target
+            entries.append(entry)
+            self.sorted.append(self._sort_key(entry[1], entry))
+            self.sorted.append(self._sort_key(target, entry))
+        self.sorted.sort()
+        self._build_blob(entries)
+
+    def _build_blob(self, entries):
+        texts = [f"{entry[1]}\x00{self.targets[entry]}".encode("utf-8") for entry in entries]
+        starts = array.array("Q", itertools.accumulate((len(t) + 1 for t in texts), initial=0))
+        # Swapped in whole so a concurrent search sees one consistent layout;
+        # it reads changed first, so folded entries are never missed
+        self.layout = (b"\n".join(texts), starts, entries)
+        # Entries changed since, oldest first and each once
+        self.changed = {}
+
+    @staticmethod
+    def _sort_key(text, entry):
+        return f"{text}\x00{entry[0]}\x00{entry[1]}"
+
+    def add(self, direction, key, tgt):
+        entry = (direction, key)
+        target = normalize(tgt)
+        old = self.targets.get(entry)
+        if old == target:
+            return
+        if old is None:
+            bisect.insort(self.sorted, self._sort_key(key, entry))
+        else:
+            i = bisect.bisect_left(self.sorted, self._sort_key(old, entry))
+            if i < len(self.sorted) and self.sorted[i] == self._sort_key(old, entry):
+                del self.sorted[i]
+        bisect.insort(self.sorted, self._sort_key(target, entry))
+        self.targets[entry] = target
+        # Re-inserting moves an entry changed again to the newest position
+        self.changed.pop(entry, None)
+        self.changed[entry] = None
+        if len(self.changed) >= self.fold_at:
+            # A pass over every entry, but only once per fold_at changes
+            self._build_blob([entry for entry in self.layout[2] if entry not in self.changed]
+                             + list(self.changed))
+
+    def prefix(self, query, offset, limit):
+        """Up to limit (direction, key) entries with a source or target starting with query"""
+        found = []
+        seen = set()
+        for i in range(bisect.bisect_left(self.sorted, query), len(self.sorted)):
+            item = self.sorted[i]
+            if not item.startswith(query):
+                break
+            _, direction, key = item.split("\x00", 2)
+            # Each entry has a source and a target row, so offset counts entries
+            if (direction, key) in seen:
+                continue
+            seen.add((direction, key))
+            if offset:
+                offset -= 1
+                continue
+            found.append((direction, key))
+            if len(found) == limit:
+                break
+        return found
+
+    def _newest_containing(self, query):
+        changed = list(self.changed)
+        blob, starts, entries = self.layout
+        yield from reversed(changed)
+        needle = query.encode("utf-8")
+        end = len(blob)
+        while True:
+            pos = blob.rfind(needle, 0, end)
+            if pos < 0:
+                return
+            i = bisect.bisect_right(starts, pos) - 1
+            yield entries[i]
+            # Continue before this entry's text
+            end = starts[i]
+
+    def substring(self, query, offset, limit):
+        """Up to limit (direction, key) entries with a source or target containing query"""
+        if not query:
+            return self.prefix(query, offset, limit)
+        found = []
+        seen = set()
+        for entry in self._newest_containing(query):
+            if entry in seen:
+                continue
+            seen.add(entry)
+            # Blob text may be out of date for entries changed since
+            if query in entry[1] or query in self.targets[entry]:
+                if offset:
+                    offset -= 1
+                    continue
+                found.append(entry)
+                if len(found) == limit:
+                    break
+        return found
+
+
+def all_entries(index, entries):
+    """((direction, key), (src, tgt)) of the index entries entries does not override, then entries"""
+    if index is not None:
+        for key, entry in index.items():
+            if key not in entries:
+                yield key, entry
+    yield from list(entries.items())
+
+
+def add_fuzzy(indexes, direction, key, src, tgt):
+    indexes.setdefault(direction, TrigramIndex()).add(key)
+
+
+def add_phrase(phrases, direction, key, src, tgt):
+    phrases.setdefault(direction, PhraseRules({})).add(src, tgt)
+
+
+def add_search(search, direction, key, src, tgt):
+    search.add(direction, key, tgt)
+
+
+def by_direction(add):
+    """A build function for a dict of per-direction structures filled by add"""
+    def build(entries):
+        value = {}
+        for (direction, key), (src, tgt) in entries:
+            add(value, direction, key, src, tgt)
+        return value
+    return build
+
+
+# Lookup structures over every entry, built on first use:
+# attribute -> (build from all entries, add one entry)
+DERIVED = {
+    "indexes": (by_direction(add_fuzzy), add_fuzzy),
+    "phrases": (by_direction(add_phrase), add_phrase),
+    # Built in bulk, which is much faster than adding entries one at a time
+    "search_index": (lambda entries: MemorySearch((key, tgt) for key, (_, tgt) in entries),
+                     add_search),
+}
+
+
+class TranslationMemory:
+    """Approved translations shared by every session in the process
+
+    Entries come from the memory-mapped index built by memory_index.py, if
+    there is one, plus the lines appended to the log since it was built.
+    Saves are visible at once and written to the log by a MemoryWriter.
+    The fuzzy, phrase and search structures are built in the background
+    on first use, so nothing waits for them while they are built.
+    """
+
+    def __init__(self, path=MEM_FILE, fuzzy_threshold=0.85, refresh_interval=REFRESH_INTERVAL):
+        self.path = path
+        self.fuzzy_threshold = fuzzy_threshold
+        self.refresh_interval = refresh_interval
+        self.refreshed = time.monotonic()
+        self.index = None
+        self.entries = {}
+        self.size = 0
+        self.indexes = None
+        self.phrases = None
+        self.search_index = None
+        # DERIVED builds in progress: attribute -> (entries added meanwhile, done event)
+        self.building = {}
+        self.generation = 0
+        self.log_offset = 0
+        self.log_id = None
+        self.lock = threading.Lock()
+        self.writer = None
+        self.load()
+
+    def load(self):
+        """Open the memory index and load the log lines it does not cover"""
+        if not os.path.exists(self.path):
+            return
+        from memory_index import MemoryIndex
+        try:
+            with metrics.MEMORY_LOAD.time():
+                self.log_id = file_id(self.path)
+                self.index = MemoryIndex.open(self.path)
+                if self.index is not None:
+                    self.log_offset = self.index.log_size
+                    self.size = len(self.index)
+                self.refresh()
+        except:
+            pass
+
+    def refresh(self):
+        """Load lines appended to the log since it was last read, by any process
+
+        Returns the (direction, normalized source, target) triples read.
+        """
+        if not os.path.exists(self.path):
+            return set()
+        if file_id(self.path) != self.log_id or os.path.getsize(self.path) < self.log_offset:
+            # Rewritten, e.g. by memory_index.py compact, so log_offset no longer applies
+            self.reload()
+            return set()
+        if os.path.getsize(self.path) <= self.log_offset:
+            return set()
+        with open(self.path, 'rb') as f:
+            f.seek(self.log_offset)
+            data = f.read()
+        # A line still being written by another process is picked up next time
+        end = data.rfind(b"\n") + 1
+        self.log_offset += end
+        added = set()
+        for line in data[:end].decode('utf-8', errors='replace').splitlines():
+            parts = line.strip().split('|||')
+            if len(parts) == 3:
+                self._add(*parts)
+                added.add((parts[0], normalize(parts[1]), parts[2]))
+        return added
+
+    def reload(self):
+        """Load the log again from scratch, keeping saves not yet written to it"""
+        self.index = None
+        self.entries = {}
+        self.size = 0
+        self.indexes = None
+        self.phrases = None
+        self.search_index = None
+        # Builds from the old log are discarded when they finish
+        self.building = {}
+        self.generation += 1
+        self.log_offset = 0
+        self.load()
+        if self.writer is not None:
+            with self.writer.lock:
+                pending = list(self.writer.pending)
+            for direction, src, tgt in pending:
+                self._add(direction, src, tgt)
+
+    def _lookup(self, direction, key):
+        entry = self.entries.get((direction, key))
+        if entry is None and self.index is not None:
+            entry = self.index.get(direction, key)
+        return entry
+
+    def _add(self, direction, src, tgt):
+        key = normalize(src)
+        if self._lookup(direction, key) is None:
+            self.size += 1
+        # Re-inserting keeps entries in order of their latest approval
+        self.entries.pop((direction, key), None)
+        self.entries[(direction, key)] = (src, tgt)
+        for name, (_, add) in DERIVED.items():
+            value = getattr(self, name)
+            if value is not None:
+                add(value, direction, key, src, tgt)
+            elif name in self.building:
+                self.building[name][0].append((direction, key, src, tgt))
+
+    def __len__(self):
+        return self.size
+
+    def get(self, direction, text):
+        key = normalize(text)
+        entry = self._lookup(direction, key)
+        if entry is None and self.poll():
+            entry = self._lookup(direction, key)
+        return entry[1] if entry else None
+
+    def poll(self):
+        """Pick up approvals written by other processes, at most once per refresh_interval
+
+        Processes that never save have no writer thread refreshing for
+        them, so misses do it instead. Returns whether the log was read.
+        """
+        now = time.monotonic()
+        if now - self.refreshed < self.refresh_interval:
+            return False
+        # Skipped while a save or flush holds the lock; that flush refreshes anyway
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            self.refreshed = now
+            self.refresh()
+        finally:
+            self.lock.release()
+        return True
+
+    def _derived(self, name, wait=False):
+        """The DERIVED structure name, or None while it is still being built
+
+        The build runs on its own thread, off the lock, from a snapshot of
+        the entries; entries added meanwhile are applied before it is
+        published. With wait, blocks until it is ready instead.
+        """
+        while True:
+            with self.lock:
+                value = getattr(self, name)
+                if value is not None:
+                    return value
+                if name not in self.building:
+                    self.building[name] = ([], threading.Event())
+                    threading.Thread(
+                        target=self._build,
+                        args=(name, self.generation, self.index, dict(self.entries),
+                              *self.building[name]),
+                        daemon=True
+                    ).start()
+                done = self.building[name][1]
+            if not wait:
+                return None
+            done.wait()
+
+    def _build(self, name, generation, index, entries, added, done):
+        build, add = DERIVED[name]
+        value = None
+        try:
+            value = build(all_entries(index, entries))
+        finally:
+            with self.lock:
+                if generation == self.generation:
+                    if value is not None:
+                        for entry in added:
+                            add(value, *entry)
+                        setattr(self, name, value)
+                    # A failed build is started again on next use
+                    del self.building[name]
+            done.set()
+
+    def warm(self):
+        """Build the fuzzy, phrase and search structures now and wait for them"""
+        for name in DERIVED:
+            self._derived(name)
+        for name in DERIVED:
+            self._derived(name, wait=True)
+
+    def fuzzy_get(self, direction, text):
+        """Closest approved translation whose source is similar enough to text
+
+        Returns None until the fuzzy index has been built.
+        """
+        if not self.fuzzy_threshold:
+            return None
+        indexes = self._derived("indexes")
+        index = indexes.get(direction) if indexes is not None else None
+        if index is None:
+            return None
+        key = normalize(text)
+        # "make she no add jara" is close to "make she add jara" but means the opposite
+        wanted = negations(key)
+        match = index.search(key, self.fuzzy_threshold,
+                             accept=lambda other: negations(other) == wanted)
+        if match is None:
+            return None
+        return self._lookup(direction, match[1])[1]
+
+    def phrase_matches(self, direction, text):
+        """Leftmost-longest stored sources found inside text, as PhraseRules.matches
+
+        Returns no matches until the phrase index has been built.
+        """
+        phrases = self._derived("phrases")
+        phrases = phrases.get(direction) if phrases is not None else None
+        return phrases.matches(text) if phrases is not None else []
+
+    def recent(self, offset=0, limit=10):
+        """One page of ((direction, src), tgt), most recently approved first
+
+        Returns the page and whether more entries follow it.
+        """
+        with self.lock:
+            newer = list(itertools.islice(reversed(self.entries), offset, offset + limit + 1))
+            page = [(key, self.entries[key]) for key in newer]
+        if self.index is not None and len(page) <= limit:
+            # Continue into the index, newest first, skipping entries saved since it was built
+            skip = max(0, offset - len(self.entries))
+            position = len(self.index) - 1
+            while position >= 0 and len(page) <= limit:
+                key, entry = self.index.entry(position)
+                position -= 1
+                if key in self.entries:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                page.append((key, entry))
+        rows = [((direction, src), tgt) for (direction, _), (src, tgt) in page]
+        return rows[:limit], len(rows) > limit
+
+    def search(self, query, prefix=False, offset=0, limit=10):
+        """One page of ((direction, src), tgt) whose source or translation contains query
+
+        With prefix, sources or translations must start with query instead.
+        Returns the page and whether more matches follow it.
+        """
+        query = normalize(query)
+        # Searches are explicit, so they wait for the index rather than miss
+        search = self._derived("search_index", wait=True)
+        find = search.prefix if prefix else search.substring
+        rows = []
+        for direction, key in find(query, offset, limit + 1):
+            entry = self._lookup(direction, key)
+            if entry is not None:
+                rows.append(((direction, entry[0]), entry[1]))
+        return rows[:limit], len(rows) > limit
+
+    def items(self):
+        for (direction, _), (src, tgt) in all_entries(self.index, self.entries):
+            yield (direction, src), tgt
+
+    def save(self, direction, src_text, tgt_text):
+        """Record an approved translation, returning False if it was already stored
+
+        The entry is visible immediately; the log write happens in the
+        background as part of the writer's next group commit. Raises
+        ValueError for text that would not fit on one log line.
+        """
+        check_pair(src_text, tgt_text)
+        with self.lock:
+            if self.get(direction, src_text) == tgt_text:
+                return False
+            self._add(direction, src_text, tgt_text)
+            if self.writer is None:
+                self.writer = MemoryWriter(self)
+            self.writer.submit(direction, src_text, tgt_text)
+        return True
+
+    def flush(self):
+        """Write any queued approvals now"""
+        if self.writer is not None:
+            self.writer.flush()
+
+
+class MemoryWriter:
+    """Single writer thread that appends approvals to the log in locked group commits"""
+
+    def __init__(self, memory, interval=FLUSH_INTERVAL, max_pending=FLUSH_SIZE):
+        self.memory = memory
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, direction, src_text, tgt_text):
+        with self.lock:
+            self.pending.append((direction, src_text, tgt_text))
+            if len(self.pending) >= self.max_pending:
+                self.wake.set()
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except OSError:
+                # Pending approvals stay queued and are retried on the next pass
+                pass
+
+    def flush(self):
+        memory = self.memory
+        with self.lock:
+            idle = not self.pending
+        if idle:
+            # Still pick up approvals written by other processes
+            with memory.lock:
+                memory.refresh()
+            return
+        with metrics.MEMORY_SAVE.time():
+            with open_locked(memory.path) as f:
+                try:
+                    with memory.lock:
+                        # Saves hold memory.lock, so every approval made before
+                        # this refresh is in the batch and every later one
+                        # already sees what other processes wrote
+                        on_disk = memory.refresh()
+                        with self.lock:
+                            batch, self.pending = self.pending, []
+                        lines = [
+                            f"{direction}|||{src}|||{tgt}\n"
+                            for direction, src, tgt in dict.fromkeys(batch)
+                            if (direction, normalize(src), tgt) not in on_disk
+                        ]
+                        try:
+                            f.seek(0, os.SEEK_END)
+                            f.write("".join(lines).encode('utf-8'))
+                            f.flush()
+                            os.fsync(f.fileno())
+                        except OSError:
+                            with self.lock:
+                                self.pending[:0] = batch
+                            raise
+                        memory.log_offset = f.tell()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SessionMemory:
+    """Per-session overlay of translations approved in this session over the shared memory"""
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.overlay = {}
+
+    def __len__(self):
+        return len(self.shared)
+
+    def get(self, direction, text):
+        tgt = self.overlay.get((direction, normalize(text)))
+        if tgt is None:
+            tgt = self.shared.get(direction, text)
+        return tgt
+
+    def fuzzy_get(self, direction, text):
+        return self.shared.fuzzy_get(direction, text)
+
+    def phrase_matches(self, direction, text):
+        return self.shared.phrase_matches(direction, text)
+
+    def recent(self, offset=0, limit=10):
+        return self.shared.recent(offset, limit)
+
+    def search(self, query, prefix=False, offset=0, limit=10):
+        return self.shared.search(query, prefix, offset, limit)
+
+    def items(self):
+        return self.shared.items()
+
+    def save(self, direction, src_text, tgt_text):
+        saved = self.shared.save(direction, src_text, tgt_text)
+        self.overlay[(direction, normalize(src_text))] = tgt_text
+        return saved
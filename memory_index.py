@@ -0,0 +1,229 @@
+"""Hashed binary index over mem.txt, memory-mapped for lookups without a full parse
+
+    python memory_index.py build [--memory mem.txt]
+    python memory_index.py compact [--memory mem.txt]
+
+mem.txt stays the append-only source of truth. build writes mem.txt.idx, an
+open-addressing hash table of every (direction, normalized source) pair in
+the log as of the build, plus their record offsets in log order for paging
+through them; lines appended later are read from the log tail at startup.
+compact rewrites mem.txt keeping only the latest translation of each
+source, then rebuilds the index.
+"""
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+from memory import MEM_FILE, normalize, open_locked
+
+MAGIC = b"PIDENIX4"
+# magic, indexed log size, log device and inode, sample digest, slot count, entry count
+HEADER = struct.Struct("<8sQQQ16sQQ")
+# Bytes hashed at each end of the indexed log to check it is unchanged
+SAMPLE = 1 << 16
+SLOT = struct.Struct("<QQ")
+OFFSET = struct.Struct("<Q")
+LENGTH = struct.Struct("<I")
+
+
+def index_path(log_path):
+    return log_path + ".idx"
+
+
+def entry_key(direction, key):
+    return f"{direction}\x00{key}".encode("utf-8")
+
+
+def key_hash(key_bytes):
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "little")
+
+
+def sample_digest(head, tail):
+    """Digest of the first and last SAMPLE bytes of the indexed log"""
+    return hashlib.blake2b(head + tail, digest_size=16).digest()
+
+
+def read_log(log_path):
+    """The log's bytes up to the end of its last complete line"""
+    with open(log_path, 'rb') as f:
+        log = f.read()
+    return log[:log.rfind(b"\n") + 1]
+
+
+def latest_entries(log):
+    """The last (src, tgt) logged for each (direction, normalized source), in log order"""
+    entries = {}
+    for line in log.decode('utf-8', errors='replace').splitlines():
+        parts = line.strip().split('|||')
+        if len(parts) != 3:
+            continue
+        direction, src, tgt = parts
+        key = (direction, normalize(src))
+        # Re-inserting moves superseded keys to their latest position
+        entries.pop(key, None)
+        entries[key] = (src, tgt)
+    return entries
+
+
+def build(log_path, out_path=None, log=None):
+    """Write the index for the log, or for log bytes read from it, and return the number of entries"""
+    out_path = out_path or index_path(log_path)
+    if log is None:
+        log = read_log(log_path)
+    entries = latest_entries(log)
+    stat = os.stat(log_path)
+    digest = sample_digest(log[:SAMPLE], log[max(0, len(log) - SAMPLE):])
+    slot_count = max(8, 2 * len(entries))
+    slots = [(0, 0)] * slot_count
+    offsets = []
+    data = bytearray()
+    data_start = HEADER.size + slot_count * SLOT.size + len(entries) * OFFSET.size
+    for (direction, key), (src, tgt) in entries.items():
+        key_bytes = entry_key(direction, key)
+        h = key_hash(key_bytes)
+        slot = h % slot_count
+        while slots[slot][1]:
+            slot = (slot + 1) % slot_count
+        slots[slot] = (h, data_start + len(data))
+        offsets.append(data_start + len(data))
+        for field in (key_bytes, src.encode("utf-8"), tgt.encode("utf-8")):
+            data += LENGTH.pack(len(field)) + field
+
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(log), stat.st_dev, stat.st_ino, digest,
+                            slot_count, len(entries)))
+        for h, offset in slots:
+            f.write(SLOT.pack(h, offset))
+        for offset in offsets:
+            f.write(OFFSET.pack(offset))
+        f.write(data)
+    os.replace(tmp_path, out_path)
+    return len(entries)
+
+
+def compact(log_path):
+    """Drop superseded lines from the log, then rebuild its index"""
+    # Hold the writers' lock so no approval is appended to the old log
+    # between reading it and replacing it
+    with open_locked(log_path):
+        entries = latest_entries(read_log(log_path))
+        log = "".join(f"{direction}|||{src}|||{tgt}\n"
+                      for (direction, _), (src, tgt) in entries.items()).encode("utf-8")
+        tmp_path = log_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(log)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, log_path)
+        return build(log_path, log=log)
+
+
+class MemoryIndex:
+    """Read-only view of a built index file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.log_size, self.log_dev, self.log_ino, self.digest,
+         self.slot_count, self.entry_count) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a translation memory index")
+        self.order_start = HEADER.size + self.slot_count * SLOT.size
+
+    @classmethod
+    def open(cls, log_path):
+        """The log's index if it exists and still describes a prefix of the log
+
+        The log must be the same file the index was built from, not one that
+        replaced it, and the ends of the indexed prefix must be unchanged,
+        so opening costs the same whatever the log's size.
+        """
+        path = index_path(log_path)
+        if not os.path.exists(path):
+            return None
+        try:
+            index = cls(path)
+        except (ValueError, struct.error):
+            return None
+        with open(log_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if (stat.st_dev, stat.st_ino) != (index.log_dev, index.log_ino):
+                # Replaced, e.g. by compaction, since the index was built
+                return None
+            if stat.st_size < index.log_size:
+                return None
+            head = f.read(min(index.log_size, SAMPLE))
+            f.seek(max(0, index.log_size - SAMPLE))
+            tail = f.read(index.log_size - f.tell())
+        if sample_digest(head, tail) != index.digest:
+            # Rewritten in place since the index was built
+            return None
+        return index
+
+    def __len__(self):
+        return self.entry_count
+
+    def _field(self, offset):
+        (length,) = LENGTH.unpack_from(self.map, offset)
+        start = offset + LENGTH.size
+        return self.map[start:start + length], start + length
+
+    def _record(self, offset):
+        key_bytes, offset = self._field(offset)
+        src, offset = self._field(offset)
+        tgt, _ = self._field(offset)
+        return key_bytes, src.decode("utf-8"), tgt.decode("utf-8")
+
+    def entry(self, position):
+        """((direction, key), (src, tgt)) of the entry at position in log order"""
+        (offset,) = OFFSET.unpack_from(self.map, self.order_start + position * OFFSET.size)
+        key_bytes, src, tgt = self._record(offset)
+        direction, key = key_bytes.decode("utf-8").split("\x00", 1)
+        return (direction, key), (src, tgt)
+
+    def get(self, direction, key):
+        """(src, tgt) stored for a direction and normalized source, or None"""
+        key_bytes = entry_key(direction, key)
+        h = key_hash(key_bytes)
+        slot = h % self.slot_count
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.map, HEADER.size + slot * SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == h:
+                stored_key, src, tgt = self._record(offset)
+                if stored_key == key_bytes:
+                    return src, tgt
+            slot = (slot + 1) % self.slot_count
+
+    def items(self):
+        """Yield ((direction, key), (src, tgt)) in log order"""
+        offset = self.order_start + self.entry_count * OFFSET.size
+        end = len(self.map)
+        while offset < end:
+            key_bytes, offset = self._field(offset)
+            src, offset = self._field(offset)
+            tgt, offset = self._field(offset)
+            direction, key = key_bytes.decode("utf-8").split("\x00", 1)
+            yield (direction, key), (src.decode("utf-8"), tgt.decode("utf-8"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=("build", "compact"))
+    parser.add_argument("--memory", default=MEM_FILE, help="translation memory log")
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        count = build(args.memory)
+    else:
+        count = compact(args.memory)
+    print(f"Indexed {count} translations from {args.memory}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
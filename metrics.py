@@ -0,0 +1,147 @@
+"""Process-wide counters and histograms exported in the Prometheus text format
+
+Set PIDEN_METRICS_PORT to serve them over HTTP at /metrics, or
+PIDEN_METRICS_FILE to rewrite a file every PIDEN_METRICS_INTERVAL seconds.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+def format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(key, [('le', bound)])} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+TIER_LATENCY = Histogram("piden_tier_latency_seconds", "Time spent in each translation tier")
+TIER_LOOKUPS = Counter("piden_tier_lookups_total", "Tier lookups by result (hit or miss)")
+MODEL_QUEUE_WAIT = Histogram("piden_model_queue_wait_seconds", "Time a request waited for a model batch")
+MODEL_BATCH_SIZE = Histogram("piden_model_batch_size", "Texts per model call", SIZE_BUCKETS)
+TOKENS_GENERATED = Counter("piden_model_tokens_generated_total", "Tokens produced by the models")
+MODEL_CACHE_LOOKUPS = Counter("piden_model_cache_lookups_total", "Model output cache lookups by result")
+MODEL_COALESCED = Counter("piden_model_coalesced_total", "Model translations shared with an identical request in flight")
+MEMORY_LOAD = Histogram("piden_memory_load_seconds", "Time to load the translation memory")
+MEMORY_SAVE = Histogram("piden_memory_save_seconds", "Time to save an approved translation")
+
+REGISTRY = [TIER_LATENCY, TIER_LOOKUPS, MODEL_QUEUE_WAIT, MODEL_BATCH_SIZE, TOKENS_GENERATED,
+            MODEL_CACHE_LOOKUPS, MODEL_COALESCED, MEMORY_LOAD, MEMORY_SAVE]
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="0.0.0.0"):
+    """Serve /metrics from a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_file(path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+def flush_periodically(path, interval):
+    def loop():
+        while True:
+            time.sleep(interval)
+            write_file(path)
+    threading.Thread(target=loop, daemon=True).start()
+
+
+def start_from_env():
+    """Start whichever exporters the environment asks for"""
+    port = os.environ.get("PIDEN_METRICS_PORT")
+    if port:
+        serve(int(port))
+    path = os.environ.get("PIDEN_METRICS_FILE")
+    if path:
+        flush_periodically(path, float(os.environ.get("PIDEN_METRICS_INTERVAL", "15")))
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent import futures
+
+import metrics
+from memory import normalize
+
+
+def cache_key(direction, text, model_id, params):
+    """Key a model output on everything that changes it"""
+    return (direction, normalize(text), model_id, json.dumps(params, sort_keys=True))
+
+
+class ModelOutputCache:
+    """Bounded LRU of model-tier translations, optionally persisted to a JSON-lines file
+
+    Translations still being generated are shared too: a text that is
+    already in flight for another caller is waited on, for at most
+    wait_timeout seconds, instead of being generated again.
+    """
+
+    def __init__(self, capacity=10000, path=None, wait_timeout=60.0):
+        self.capacity = capacity
+        self.path = path
+        self.wait_timeout = wait_timeout
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.inflight = {}
+        self.lock = threading.Lock()
+        # Appends to the file, kept apart from lock so lookups never wait on the disk
+        self.file_lock = threading.Lock()
+        if path:
+            self.load()
+
+    def load(self):
+        """Reload persisted outputs, keeping the most recent capacity entries"""
+        if not os.path.exists(self.path):
+            return
+        lines = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    key, value = json.loads(line)
+                except ValueError:
+                    continue
+                lines += 1
+                self._store(tuple(key), value)
+        # The file is append-only, so rewrite it once it holds mostly stale lines
+        if lines > 2 * self.capacity:
+            self.compact()
+
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, value in self.entries.items():
+                f.write(json.dumps([key, value], ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _store(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+        metrics.MODEL_CACHE_LOOKUPS.inc(result="miss" if value is None else "hit")
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._store(key, value)
+        if not self.path:
+            return
+        line = json.dumps([key, value], ensure_ascii=False) + "\n"
+        try:
+            with self.file_lock, open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+        except OSError:
+            # Persistence is optional; the output is still cached in memory
+            pass
+
+    def translate(self, direction, model_id, params, texts, run):
+        """Translate texts, calling run only for the ones not already cached or in flight"""
+        keys = [cache_key(direction, text, model_id, params) for text in texts]
+        return self._translate(keys, texts, run)
+
+    def _translate(self, keys, texts, run):
+        results = [self.get(key) for key in keys]
+        owned = []
+        waiting = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                if results[i] is not None:
+                    continue
+                if key in self.inflight:
+                    waiting.append((i, self.inflight[key]))
+                elif key in self.entries:
+                    # Finished by another caller since the lookup above
+                    results[i] = self.entries[key]
+                else:
+                    self.inflight[key] = futures.Future()
+                    owned.append(i)
+            self.coalesced += len(waiting)
+        if waiting:
+            metrics.MODEL_COALESCED.inc(len(waiting))
+
+        if owned:
+            error = None
+            try:
+                outputs = run([texts[i] for i in owned])
+                for i, output in zip(owned, outputs):
+                    results[i] = output
+                for i, output in zip(owned, outputs):
+                    self.put(keys[i], output)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                # Every owned key leaves inflight, even if put failed part way
+                with self.lock:
+                    pending = [(i, self.inflight.pop(keys[i])) for i in owned]
+                for i, future in pending:
+                    if results[i] is not None:
+                        future.set_result(results[i])
+                    elif error is None or isinstance(error, (futures.TimeoutError, futures.CancelledError)):
+                        # Only this caller gave up; anyone waiting tries again themselves
+                        future.cancel()
+                    else:
+                        future.set_exception(error)
+
+        for i, future in waiting:
+            try:
+                results[i] = future.result(timeout=self.wait_timeout)
+            except futures.CancelledError:
+                results[i] = self._translate([keys[i]], [texts[i]], run)[0]
+        return results
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "coalesced": self.coalesced}
@@ -0,0 +1,396 @@
+import argparse
+import gc
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import metrics
+
+MODEL_IDS = {
+    "pidgin_to_english": "Xara2west/pidgin-to-english-translator-final09",
+    "english_to_pidgin": "Xara2west/pidgin-translator-final06"
+}
+
+# Task prefixes the T5 checkpoints were fine-tuned with
+PREFIXES = {
+    "pidgin_to_english": "translate Pidgin to English: ",
+    "english_to_pidgin": "translate English to Pidgin: "
+}
+
+# Seconds a model may sit unused before it is freed; 0 keeps it loaded
+IDLE_TIMEOUT = float(os.environ.get("PIDEN_MODEL_IDLE_TIMEOUT", "0"))
+# Seconds a streamed translation may go without a new token before it is abandoned
+STREAM_TIMEOUT = float(os.environ.get("PIDEN_STREAM_TIMEOUT", "60"))
+
+
+# Inference backend: "eager" (fp32), "int8" (dynamic quantization) or "compiled"
+BACKEND = os.environ.get("PIDEN_MODEL_BACKEND", "eager")
+BACKENDS = ("eager", "int8", "compiled")
+
+
+def apply_backend(model, backend=BACKEND):
+    """Prepare a loaded seq2seq model for CPU inference with the chosen backend"""
+    import torch
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown model backend {backend!r}, expected one of {BACKENDS}")
+    model.eval()
+    if backend == "int8":
+        # Linear layers hold nearly all of T5's weights and compute
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == "compiled":
+        # Compile forward rather than the module so generate() runs the compiled graph
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+# Local checkpoints, one subdirectory per model ID with "/" written as "--"
+# (see export_checkpoints); used instead of the Hugging Face hub when present
+MODEL_DIR = os.environ.get("PIDEN_MODEL_DIR")
+# Never reach for the network: a model without a local checkpoint is an error
+OFFLINE = os.environ.get("PIDEN_OFFLINE", "0") == "1"
+# Map local safetensors weights read-only so processes share one copy in the page cache
+MMAP_WEIGHTS = os.environ.get("PIDEN_MODEL_MMAP", "1") == "1"
+
+SAFETENSORS_FILE = "model.safetensors"
+SAFETENSORS_DTYPES = {"F32": "float32", "F16": "float16", "BF16": "bfloat16", "F64": "float64",
+                      "I64": "int64", "I32": "int32", "I16": "int16", "I8": "int8",
+                      "U8": "uint8", "BOOL": "bool"}
+
+
+def local_checkpoint(model_id, model_dir=None):
+    """Local directory holding model_id, or None"""
+    if os.path.isdir(model_id):
+        return model_id
+    model_dir = model_dir or MODEL_DIR
+    if model_dir:
+        path = os.path.join(model_dir, model_id.replace("/", "--"))
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+def checkpoint_path(model_id):
+    """Where to load model_id from: its local checkpoint, else the hub ID unless offline"""
+    path = local_checkpoint(model_id)
+    if path is not None:
+        return path
+    if OFFLINE:
+        raise FileNotFoundError(
+            f"No local checkpoint for {model_id} under PIDEN_MODEL_DIR={MODEL_DIR!r} "
+            "and PIDEN_OFFLINE=1 forbids downloading it")
+    return model_id
+
+
+def read_safetensors_header(data):
+    """Tensor layout of a safetensors file as {name: (dtype, shape, start, end)}
+
+    Offsets are absolute positions in data, which can be a memory map.
+    """
+    (header_size,) = struct.unpack_from("<Q", data, 0)
+    header = json.loads(bytes(data[8:8 + header_size]))
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        start, end = info["data_offsets"]
+        tensors[name] = (info["dtype"], info["shape"], 8 + header_size + start, 8 + header_size + end)
+    return tensors
+
+
+def map_weights(model, path):
+    """Point model's parameters at a read-only memory map of the safetensors file at path
+
+    Nothing is copied, so every process mapping the same file shares its
+    pages. The weights must not be modified in place.
+    """
+    import torch
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    for name, (dtype, shape, start, end) in read_safetensors_header(data).items():
+        dtype = getattr(torch, SAFETENSORS_DTYPES[dtype])
+        count = (end - start) // torch.tensor([], dtype=dtype).element_size()
+        # frombuffer warns that the map is not writable; inference never writes it
+        tensor = torch.frombuffer(data, dtype=dtype, count=count, offset=start).reshape(shape)
+        module_name, _, attr = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attr in module._parameters:
+            module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+        elif attr in module._buffers:
+            module._buffers[attr] = tensor
+    # Embeddings tied to ones saved under another name
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(f"{path} has no weights for {', '.join(missing)}")
+    # Keep the map open for as long as the model lives
+    model.weights_map = data
+    return model
+
+
+def load_weights(model_class, path, backend=BACKEND):
+    """model_class.from_pretrained(path), memory-mapping local safetensors weights when possible"""
+    weights = os.path.join(path, SAFETENSORS_FILE)
+    # int8 quantization makes private copies of the weights anyway
+    if not MMAP_WEIGHTS or backend == "int8" or not os.path.exists(weights):
+        return model_class.from_pretrained(path, local_files_only=OFFLINE)
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig
+    config = AutoConfig.from_pretrained(path, local_files_only=True)
+    with init_empty_weights():
+        if hasattr(model_class, "from_config"):
+            model = model_class.from_config(config)
+        else:
+            model = model_class(config)
+    return map_weights(model, weights)
+
+
+def export_checkpoints(model_dir, model_ids=None):
+    """Download each model once and save it under model_dir for offline, mapped loading"""
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+    for model_id in (model_ids or MODEL_IDS.values()):
+        path = os.path.join(model_dir, model_id.replace("/", "--"))
+        AutoTokenizer.from_pretrained(model_id).save_pretrained(path)
+        AutoModelForSeq2SeqLM.from_pretrained(model_id).save_pretrained(path, safe_serialization=True)
+        print(f"Saved {model_id} to {path}", file=sys.stderr)
+
+
+def load_pipeline(model_id, backend=BACKEND):
+    """Translation pipeline as used by piden.py"""
+    import torch
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, pipeline
+    path = checkpoint_path(model_id)
+    tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=OFFLINE)
+    model = apply_backend(load_weights(AutoModelForSeq2SeqLM, path, backend), backend)
+    # Quantized and compiled models are CPU-only
+    use_gpu = backend == "eager" and torch.cuda.is_available()
+    return pipeline(
+        "translation_en_to_fr",  # Changed task type
+        model=model,
+        tokenizer=tokenizer,
+        device=0 if use_gpu else -1
+    )
+
+
+def load_t5(model_id, backend=BACKEND):
+    """Tokenizer and model pair as used by sc.py"""
+    from transformers import T5Tokenizer, T5ForConditionalGeneration
+    path = checkpoint_path(model_id)
+    tokenizer = T5Tokenizer.from_pretrained(path, local_files_only=OFFLINE)
+    model = apply_backend(load_weights(T5ForConditionalGeneration, path, backend), backend)
+    return tokenizer, model
+
+
+# Named decoding settings, cheapest last; "length" is (ratio, slack) for the
+# output token budget relative to the longest input in the batch
+DECODING_PROFILES = {
+    "quality": {
+        "generate": {"num_beams": 5, "early_stopping": True, "repetition_penalty": 2.5,
+                     "length_penalty": 1.0, "no_repeat_ngram_size": 3},
+        "length": (2.0, 10),
+    },
+    "balanced": {
+        "generate": {"num_beams": 2, "early_stopping": True, "no_repeat_ngram_size": 3},
+        "length": (1.5, 8),
+    },
+    "fast": {
+        "generate": {"num_beams": 1, "do_sample": False},
+        "length": (1.5, 8),
+    },
+}
+PROFILE_ORDER = tuple(DECODING_PROFILES)
+
+# Queue depths at which requests fall back to cheaper profiles
+DEGRADE_DEPTHS = {
+    "balanced": int(os.environ.get("PIDEN_DEGRADE_BALANCED_DEPTH", "8")),
+    "fast": int(os.environ.get("PIDEN_DEGRADE_FAST_DEPTH", "32")),
+}
+
+
+def profile_for_load(requested, queue_depth):
+    """The requested profile, or a cheaper one when the model queue is deep"""
+    allowed = PROFILE_ORDER[0]
+    for name, depth in DEGRADE_DEPTHS.items():
+        if queue_depth >= depth:
+            allowed = name
+    return max(requested, allowed, key=PROFILE_ORDER.index)
+
+
+def length_budget(profile, input_tokens, max_length=512):
+    ratio, slack = DECODING_PROFILES[profile]["length"]
+    return min(max_length, int(ratio * min(input_tokens, max_length)) + slack)
+
+
+def check_parity(model_id, backend, texts, prefix="", profile="quality"):
+    """Compare a backend's translations of texts against eager fp32 ones
+
+    Returns the fraction of identical outputs and the (text, fp32, backend)
+    triples that differ.
+    """
+    tokenizer, reference = load_t5(model_id, "eager")
+    expected = generate_t5(tokenizer, reference, prefix, texts, profile)
+    del reference
+    _, candidate = load_t5(model_id, backend)
+    actual = generate_t5(tokenizer, candidate, prefix, texts, profile)
+    diffs = [(t, e, a) for t, e, a in zip(texts, expected, actual) if e != a]
+    return 1 - len(diffs) / len(texts) if texts else 1.0, diffs
+
+
+def run_pipeline(pipe, texts, profile="quality", max_length=512):
+    """Translate a batch of texts with a translation pipeline"""
+    longest = max(len(ids) for ids in pipe.tokenizer(texts).input_ids)
+    outputs = pipe(
+        texts,
+        # The pipeline otherwise generates one text at a time
+        batch_size=len(texts),
+        max_new_tokens=length_budget(profile, longest, max_length),
+        **DECODING_PROFILES[profile]["generate"]
+    )
+    outputs = [output['translation_text'] for output in outputs]
+    metrics.TOKENS_GENERATED.inc(sum(len(ids) for ids in pipe.tokenizer(outputs).input_ids))
+    return outputs
+
+
+def generate_t5(tokenizer, model, prefix, texts, profile="quality", batch_size=16, max_length=512):
+    """Translate texts with a T5 model, batching inputs of similar length together"""
+    # Sort by token count so each batch pads only to its own longest input
+    lengths = [len(tokenizer(prefix + text).input_ids) for text in texts]
+    order = sorted(range(len(texts)), key=lambda i: lengths[i])
+    results = [None] * len(texts)
+
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        inputs = tokenizer(
+            [prefix + texts[i] for i in bucket],
+            return_tensors="pt",
+            max_length=max_length,
+            truncation=True,
+            padding="longest"
+        )
+
+        # Translations rarely run much longer than their source
+        outputs = model.generate(
+            input_ids=inputs.input_ids,
+            attention_mask=inputs.attention_mask,
+            max_new_tokens=length_budget(profile, max(lengths[i] for i in bucket), max_length),
+            **DECODING_PROFILES[profile]["generate"]
+        )
+
+        metrics.TOKENS_GENERATED.inc(int((outputs != tokenizer.pad_token_id).sum()))
+        for i, output in zip(bucket, outputs):
+            results[i] = tokenizer.decode(output, skip_special_tokens=True)
+
+    return results
+
+
+def can_stream(profile):
+    """Streaming only works for single-sequence (greedy or sampling) decoding"""
+    return DECODING_PROFILES[profile]["generate"].get("num_beams", 1) == 1
+
+
+def stream_t5(tokenizer, model, prefix, text, profile="fast", max_length=512,
+              timeout=STREAM_TIMEOUT):
+    """Yield the translation of text so far each time the model decodes more of it
+
+    Errors from generate are raised here; a stall longer than timeout
+    seconds raises queue.Empty.
+    """
+    from transformers import TextIteratorStreamer
+    if not can_stream(profile):
+        raise ValueError(f"Decoding profile {profile!r} uses beam search and cannot stream")
+    inputs = tokenizer(prefix + text, return_tensors="pt", max_length=max_length, truncation=True)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True,
+                                    timeout=timeout)
+    kwargs = dict(
+        input_ids=inputs.input_ids,
+        attention_mask=inputs.attention_mask,
+        max_new_tokens=length_budget(profile, inputs.input_ids.shape[1], max_length),
+        streamer=streamer,
+        **DECODING_PROFILES[profile]["generate"]
+    )
+    errors = []
+
+    def generate():
+        try:
+            model.generate(**kwargs)
+        except BaseException as e:
+            errors.append(e)
+            # Unblock the loop below, which would otherwise wait for more text
+            streamer.end()
+
+    thread = threading.Thread(target=generate, daemon=True)
+    thread.start()
+    text_so_far = ""
+    for chunk in streamer:
+        text_so_far += chunk
+        yield text_so_far
+    thread.join()
+    if errors:
+        raise errors[0]
+    metrics.TOKENS_GENERATED.inc(len(tokenizer(text_so_far).input_ids))
+
+
+def stream_pipeline(pipe, text, profile="fast", max_length=512):
+    """stream_t5 for a translation pipeline, using the prefix the pipeline would add"""
+    prefix = getattr(pipe.model.config, "prefix", None) or ""
+    return stream_t5(pipe.tokenizer, pipe.model, prefix, text, profile, max_length)
+
+
+class LazyModel:
+    """Loads a model on first use and frees it again after idle_timeout seconds"""
+
+    def __init__(self, loader, idle_timeout=IDLE_TIMEOUT):
+        self.loader = loader
+        self.idle_timeout = idle_timeout
+        self.model = None
+        # Set by the first successful load and kept when the model is freed for idling
+        self.loadable = False
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def get(self, touch=True):
+        """The model, loading it if needed; touch=False leaves the idle timer alone"""
+        with self.lock:
+            if self.model is None:
+                self.model = self.loader()
+                self.loadable = True
+                if self.idle_timeout > 0 and self.reaper is None:
+                    self.reaper = threading.Thread(target=self._reap, daemon=True)
+                    self.reaper.start()
+            if touch:
+                self.last_used = time.monotonic()
+            return self.model
+
+    def _reap(self):
+        while True:
+            time.sleep(min(self.idle_timeout / 2, 60))
+            with self.lock:
+                idle = self.model is not None and time.monotonic() - self.last_used > self.idle_timeout
+                if idle:
+                    self.model = None
+                elif self.model is None:
+                    self.reaper = None
+                    return
+            if idle:
+                gc.collect()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Save the translation models as local checkpoints")
+    parser.add_argument("command", choices=("export",))
+    parser.add_argument("--model-dir", default=MODEL_DIR, required=MODEL_DIR is None,
+                        help="directory to save into, later used as PIDEN_MODEL_DIR")
+    args = parser.parse_args(argv)
+    export_checkpoints(args.model_dir)
+
+
+if __name__ == "__main__":
+    main()
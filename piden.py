@@ -1,9 +1,8 @@
-import re
 import streamlit as st
-from transformers import pipeline
-import torch
-import os
-from PIL import Image
+import cascade
+from core import Translator
+from memory import MEM_FILE, SessionMemory
+import metrics
 
 # Set page config with green theme
 st.set_page_config(
@@ -89,6 +88,8 @@ st.markdown("""
     .memory-tag { background-color: #ffeb3b; color: #333; }
     .rule-tag { background-color: #4caf50; color: white; }
     .model-tag { background-color: #2196f3; color: white; }
+    .mixed-tag { background-color: #9e9e9e; color: white; }
+    .composed-tag { background-color: #ff9800; color: white; }
     
     .footer {
         text-align: center;
@@ -119,73 +120,7 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
-# Define translation rules
-translation_rules = {
-    "pidgin_to_english": {
-        r'\bhow far\b': 'how are you',
-        r'\babeg\b': 'please',
-        r'\bna\b': 'is',
-        r'\byou fit\b': 'can you',
-        r'\bdey go\b': 'going',
-        r'\bi\b': "I'm",
-        r'\bi dey\b': "I am",
-        r'\bwetin\b': 'what',
-        r'\bwetin dey happen\b': 'what is happening',
-        r'\bwetin happen\b': 'what happened',
-        r'\be don do\b': "that's enough",
-        r'\byou sabi\b': 'do you know',
-        r'\bsabi\b': 'know',
-        r'\bthey sabi\b': 'they know',
-        r'\bhe sabi\b': 'he know',
-        r'\bshe sabi\b': 'she know',
-        r'\bi sabi sabi\b': 'I know very well',
-        r'\bi no sabi\b': "I don't know",
-        r'\bi no know\b': "I don't know",
-        r'\be be like say\b': 'it seems like',
-        r'\bno wahala\b': 'no problem',
-        r'\byou wan chop\b': 'do you want to eat',
-        r'\bna dem\b': 'they are',
-        r'\bmake we go\b': "let's go",
-        r'\bna wetin\b': 'that is what',
-        r'\buna\b': 'you all',
-        r'\bchai\b': 'oh no',
-        r'\bpopo\b': 'police',
-    },
-    "english_to_pidgin": {
-        r'\bhow are you\b': 'how far',
-        r'\bplease\b': 'abeg',
-        r'\bis\b': 'na',
-        r'\bcan you\b': 'you fit',
-        r'\bgoing\b': 'dey go',
-        r"\bI'm\b": 'i',
-        r'\bI am\b': 'i dey',
-        r'\bwhat is happening\b': 'wetin dey happen',
-        r'\bwhat happened\b': 'wetin happen',
-        r'\bwhat\b': 'wetin',
-        r"\bthat's enough\b": 'e don do',
-        r'\bdo you know\b': 'you sabi',
-        r'\bknow\b': 'sabi',
-        r'\bdont\b': 'no',
-        r'\bthey know\b': 'they sabi',
-        r'\bhe know\b': 'he sabi',
-        r'\bshe know\b': 'she sabi',
-        r'\bi know\b': 'i sabi',
-        r"\bI don't know\b": 'i no sabi',
-        r'\bit seems like\b': 'e be like say',
-        r'\bno problem\b': 'no wahala',
-        r'\bdo you want to eat\b': 'you wan chop',
-        r'\bthey are\b': 'na dem',
-        r"\blet's go\b": 'make we go',
-        r'\bthat is what\b': 'na wetin',
-        r'\byou all\b': 'una',
-        r'\boh no\b': 'chai',
-        r'\bpolice\b': 'popo',
-    }
-}
-
 # Initialize session state
-if 'memory' not in st.session_state:
-    st.session_state.memory = {}
 if 'history' not in st.session_state:
     st.session_state.history = []
 if 'translation_result' not in st.session_state:
@@ -194,130 +129,102 @@ if 'translation_method' not in st.session_state:
     st.session_state.translation_method = ""
 if 'feedback_requested' not in st.session_state:
     st.session_state.feedback_requested = False
-if 'models_loaded' not in st.session_state:
-    st.session_state.models_loaded = False
 if 'current_input' not in st.session_state:
     st.session_state.current_input = ""
 if 'current_direction' not in st.session_state:
     st.session_state.current_direction = ""
+if 'translation_segments' not in st.session_state:
+    st.session_state.translation_segments = []
+if 'decoding_profile' not in st.session_state:
+    st.session_state.decoding_profile = "balanced"
 if 'attempted_methods' not in st.session_state:
     st.session_state.attempted_methods = set()
-if 'approved_translations' not in st.session_state:
-    st.session_state.approved_translations = set()
+if 'speculation' not in st.session_state:
+    st.session_state.speculation = None
+if 'memory_page' not in st.session_state:
+    st.session_state.memory_page = 0
 
-# Memory system
-MEM_FILE = "mem.txt"
+# Memory, rules and models are shared by every session in the process
+@st.cache_resource(show_spinner=False)
+def load_translator():
+    """Load the translation memory once per process; models load on first use"""
+    metrics.start_from_env()
+    return Translator.from_env(memory_path=MEM_FILE)
 
-def load_memory():
-    """Load approved translations from memory file"""
-    if not os.path.exists(MEM_FILE):
-        return {}
-    
-    translations = {}
-    try:
-        with open(MEM_FILE, 'r', encoding='utf-8') as f:
-            for line in f:
-                parts = line.strip().split('|||')
-                if len(parts) == 3:
-                    direction, src, tgt = parts
-                    translations[(direction, src)] = tgt
-                    st.session_state.approved_translations.add((direction, src, tgt))
-    except:
-        pass
-    return translations
+translator = load_translator()
 
 def save_to_memory(direction, src_text, tgt_text):
     """Save approved translation to memory file only if it's not already saved"""
-    if (direction, src_text, tgt_text) in st.session_state.approved_translations:
-        return
-        
+    # Each memory entry is one line, so multi-line passages are saved flattened
+    src_text = " ".join(src_text.split())
+    tgt_text = " ".join(tgt_text.split())
     try:
-        with open(MEM_FILE, 'a', encoding='utf-8') as f:
-            f.write(f"{direction}|||{src_text}|||{tgt_text}\n")
-        st.session_state.memory[(direction, src_text)] = tgt_text
-        st.session_state.approved_translations.add((direction, src_text, tgt_text))
-        st.toast("✅ Translation saved to memory!")
+        if st.session_state.memory.save(direction, src_text, tgt_text):
+            st.toast("✅ Translation saved to memory!")
     except Exception as e:
         st.error(f"Error saving to memory: {str(e)}")
 
-# Load models with caching
-# Replace your pipeline initialization with:
-@st.cache_resource(show_spinner=False)
-def load_models():
-    """Load translation models with caching"""
-    with st.spinner("Loading translation models... This may take a minute"):
-        pidgin_to_english = pipeline(
-            "translation_en_to_fr",  # Changed task type
-            model="Xara2west/pidgin-to-english-translator-final09",
-            device=0 if torch.cuda.is_available() else -1
-        )
-        english_to_pidgin = pipeline(
-            "translation_en_to_fr",  # Changed task type
-            model="Xara2west/pidgin-translator-final06",
-            device=0 if torch.cuda.is_available() else -1
-        )
-    return pidgin_to_english, english_to_pidgin
+def reset_memory_page():
+    """Start the Memory Insights listing from its first page again"""
+    st.session_state.memory_page = 0
 
-# Load models on first run
-if not st.session_state.models_loaded:
-    pidgin_to_english_model, english_to_pidgin_model = load_models()
-    st.session_state.models = (pidgin_to_english_model, english_to_pidgin_model)
-    st.session_state.memory = load_memory()
-    st.session_state.models_loaded = True
+# Every session reads the shared memory through its own overlay
+if 'memory' not in st.session_state:
+    st.session_state.memory = SessionMemory(translator.memory)
 
-def apply_rules(text, rules):
-    """Apply translation rules with regex patterns"""
-    original_text = text
-    for pattern, replacement in rules.items():
-        text = re.sub(pattern, replacement, text, flags=re.IGNORECASE)
-    return text, text != original_text
+# Set by the UI while a translation runs so single model outputs can stream into it
+stream_placeholder = None
 
-def translate_pidgin_to_english(text, force_method=None):
-    """Translate Pidgin to English with memory first approach"""
-    # Check memory first unless we're forcing a method
-    if force_method != "memory":
-        mem_key = ("pidgin_to_english", text)
-        if mem_key in st.session_state.memory:
-            return st.session_state.memory[mem_key], "memory"
-    
-    # Apply rules if we're not forcing model-based
-    if force_method != "model-based":
-        rule_translation, changed = apply_rules(text, translation_rules["pidgin_to_english"])
-        if changed:
-            return rule_translation, "rule-based"
-    
-    # Use model if we're not forcing rule-based
-    if force_method != "rule-based":
-        model_output = st.session_state.models[0](text)[0]['translation_text']
-        return model_output, "model-based"
-    
-    # If we get here, return the original text
-    return text, "none"
+def show_partial(translated):
+    """Render a model translation progressively as it is decoded"""
+    stream_placeholder.markdown(f"<div class='translation-box'><h4>Translation Result <span class='method-tag model-tag'>AI Model</span></h4><p style='font-size: 18px;'>{translated} ▌</p></div>", 
+                                unsafe_allow_html=True)
 
-def translate_english_to_pidgin(text, force_method=None):
-    """Translate English to Pidgin with memory first approach"""
-    # Check memory first unless we're forcing a method
-    if force_method != "memory":
-        mem_key = ("english_to_pidgin", text)
-        if mem_key in st.session_state.memory:
-            return st.session_state.memory[mem_key], "memory"
-    
-    # Apply rules if we're not forcing model-based
-    if force_method != "model-based":
-        rule_translation, changed = apply_rules(text, translation_rules["english_to_pidgin"])
-        if changed:
-            return rule_translation, "rule-based"
-    
-    # Use model if we're not forcing rule-based
-    if force_method != "rule-based":
-        model_output = st.session_state.models[1](text)[0]['translation_text']
-        return model_output, "model-based"
-    
-    # If we get here, return the original text
-    return text, "none"
+def translate_pidgin_to_english(text, only=None):
+    """Translate Pidgin to English with memory first approach, or with only one method"""
+    translated, method, segments = translator.translate(
+        "pidgin_to_english", text, st.session_state.memory,
+        only=only,
+        profile=st.session_state.decoding_profile,
+        stream=show_partial if stream_placeholder is not None else None
+    )
+    st.session_state.translation_segments = segments
+    return translated, method
+
+def translate_english_to_pidgin(text, only=None):
+    """Translate English to Pidgin with memory first approach, or with only one method"""
+    translated, method, segments = translator.translate(
+        "english_to_pidgin", text, st.session_state.memory,
+        only=only,
+        profile=st.session_state.decoding_profile,
+        stream=show_partial if stream_placeholder is not None else None
+    )
+    st.session_state.translation_segments = segments
+    return translated, method
+
+def cancel_speculation():
+    """Stop preparing fallbacks for the previous input"""
+    if st.session_state.speculation is not None:
+        st.session_state.speculation.cancel()
+        st.session_state.speculation = None
+
+# Memory entries shown per page in Memory Insights
+MEMORY_PAGE_SIZE = 5
+
+# Methods "Needs Improvement" can fall back on
+FEEDBACK_METHODS = {"memory", "rule-based", "model-based"}
+# The feedback method each cascade result counts as having tried
+FEEDBACK_METHOD_OF = {
+    "memory": "memory",
+    "fuzzy-memory": "memory",
+    "composed": "memory",
+    "rule-based": "rule-based",
+    "model-based": "model-based",
+}
 
 def handle_translation(direction, text):
     """Handle translation with feedback logic"""
+    cancel_speculation()
     st.session_state.current_input = text
     st.session_state.current_direction = direction
     st.session_state.attempted_methods = set()  # Reset attempted methods
@@ -327,7 +234,15 @@ def handle_translation(direction, text):
     else:
         translated, method = translate_english_to_pidgin(text)
     
-    st.session_state.attempted_methods.add(method)
+    if method in FEEDBACK_METHOD_OF:
+        st.session_state.attempted_methods.add(FEEDBACK_METHOD_OF[method])
+    
+    # Prepare the other methods' translations in case the user asks for one
+    st.session_state.speculation = translator.speculate(
+        direction, text, st.session_state.memory,
+        methods=FEEDBACK_METHODS - st.session_state.attempted_methods,
+        profile=st.session_state.decoding_profile
+    )
     
     # Add to history
     st.session_state.history.insert(0, {
@@ -357,26 +272,35 @@ def handle_feedback(feedback):
         st.session_state.feedback_requested = True
         
         # Determine which methods haven't been tried yet
-        available_methods = {"memory", "rule-based", "model-based"}
-        remaining_methods = available_methods - st.session_state.attempted_methods
+        remaining_methods = FEEDBACK_METHODS - st.session_state.attempted_methods
         
         if remaining_methods:
             # Try the next available method
-            if st.session_state.current_direction == "pidgin_to_english":
+            next_method = next(iter(remaining_methods))
+            candidate = None
+            if st.session_state.speculation is not None:
+                candidate = st.session_state.speculation.result(next_method)
+            if candidate is not None:
+                # Already translated in the background
+                translated, method, st.session_state.translation_segments = candidate
+            elif st.session_state.current_direction == "pidgin_to_english":
                 translated, method = translate_pidgin_to_english(
                     st.session_state.current_input,
-                    force_method=next(iter(remaining_methods))
+                    only=next_method
                 )
             else:
                 translated, method = translate_english_to_pidgin(
                     st.session_state.current_input,
-                    force_method=next(iter(remaining_methods))
+                    only=next_method
                 )
             
             # Update the translation result and method
             st.session_state.translation_result = translated
             st.session_state.translation_method = method
-            st.session_state.attempted_methods.add(method)
+            # The attempt used next_method alone, so it has now been tried
+            st.session_state.attempted_methods.add(next_method)
+            if method in FEEDBACK_METHOD_OF:
+                st.session_state.attempted_methods.add(FEEDBACK_METHOD_OF[method])
             
             # Update the history with the new attempt
             st.session_state.history[0]["output"] = translated
@@ -409,49 +333,81 @@ with col1:
                          index=0,
                          label_visibility="collapsed")
     
+    # Decoding profile for the AI model tier
+    st.select_slider("AI model decoding:",
+                     options=["fast", "balanced", "quality"],
+                     key="decoding_profile",
+                     help="Faster decoding trades some accuracy for speed. Busy servers may decode faster than selected.")
+    
     # Text input
     input_text = st.text_area("Enter text to translate:", 
                              height=150,
                              placeholder="Type your text here...",
                              key="input_text")
+    if input_text != st.session_state.current_input:
+        cancel_speculation()
     
     # Translate button
     translate_btn = st.button("Translate", type="primary", use_container_width=True)
     
     # Translation result
     if translate_btn and input_text:
+        stream_placeholder = st.empty()
         try:
             if direction == "Pidgin to English":
                 direction_key = "pidgin_to_english"
             else:
                 direction_key = "english_to_pidgin"
                 
-            translation, method = handle_translation(direction_key, input_text)
+            with st.spinner("Translating..."):
+                translation, method = handle_translation(direction_key, input_text)
             
             st.session_state.translation_result = translation
             st.session_state.translation_method = method
             st.session_state.feedback_requested = True
         except Exception as e:
             st.error(f"Translation error: {str(e)}")
+        stream_placeholder.empty()
+        stream_placeholder = None
     
     # Display translation result
     if st.session_state.translation_result:
         method = st.session_state.translation_method
         method_tag = {
             "memory": "memory-tag",
+            "fuzzy-memory": "memory-tag",
             "rule-based": "rule-tag",
-            "model-based": "model-tag"
-        }.get(method, "")
+            "model-based": "model-tag",
+            "composed": "composed-tag",
+            "mixed": "mixed-tag"
+        }
         
         method_label = {
             "memory": "Memory",
+            "fuzzy-memory": "Memory (similar)",
             "rule-based": "Rule-based",
-            "model-based": "AI Model"
-        }.get(method, "Unknown")
+            "model-based": "AI Model",
+            "composed": "Memory phrases",
+            "mixed": "Mixed"
+        }
         
-        st.markdown(f"<div class='translation-box'><h4>Translation Result <span class='method-tag {method_tag}'>{method_label}</span></h4><p style='font-size: 18px;'>{st.session_state.translation_result}</p></div>", 
+        st.markdown(f"<div class='translation-box'><h4>Translation Result <span class='method-tag {method_tag.get(method, '')}'>{method_label.get(method, 'Unknown')}</span></h4><p style='font-size: 18px;'>{st.session_state.translation_result}</p></div>", 
                    unsafe_allow_html=True)
         
+        # Share of the input that did not need the AI model
+        if method in ("composed", "mixed"):
+            st.caption(f"{cascade.coverage(st.session_state.translation_segments):.0%} of words translated from memory and rules")
+        
+        # Show how each sentence was translated when the methods differ
+        if method == "mixed":
+            for src, tgt, seg_method in st.session_state.translation_segments:
+                st.markdown(f"""
+                    <div class="history-item">
+                        <div><strong>{src}</strong> → {tgt}</div>
+                        <span class='method-tag {method_tag.get(seg_method, '')}'>{method_label.get(seg_method, 'Unknown')}</span>
+                    </div>
+                """, unsafe_allow_html=True)
+        
         # Feedback section
         if st.session_state.feedback_requested:
             st.subheader("Is this translation accurate?")
@@ -477,16 +433,46 @@ with col2:
     if st.session_state.memory:
         mem_count = len(st.session_state.memory)
         st.metric("Stored Translations", mem_count)
+        cache_stats = translator.cache.stats()
+        st.caption(f"AI model cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['coalesced']} shared in flight")
         
-        # Show some memory entries
-        st.write("**Recent Memory Entries:**")
-        for i, ((direction, src), tgt) in enumerate(list(st.session_state.memory.items())[:5]):
+        # Browse or search memory a page at a time
+        memory_query = st.text_input("Search memory:",
+                                     placeholder="Search sources and translations...",
+                                     key="memory_query",
+                                     on_change=reset_memory_page)
+        prefix_search = st.checkbox("Match start only", key="memory_prefix",
+                                    on_change=reset_memory_page)
+        offset = st.session_state.memory_page * MEMORY_PAGE_SIZE
+        if memory_query.strip():
+            st.write("**Matching Memory Entries:**")
+            entries, more = st.session_state.memory.search(memory_query, prefix=prefix_search,
+                                                           offset=offset, limit=MEMORY_PAGE_SIZE)
+        else:
+            st.write("**Recent Memory Entries:**")
+            entries, more = st.session_state.memory.recent(offset, MEMORY_PAGE_SIZE)
+        if not entries:
+            st.caption("No matching entries.")
+        for (direction, src), tgt in entries:
             st.markdown(f"""
                 <div class="history-item">
                     <div><strong>{src}</strong> → {tgt}</div>
                     <small>{direction.replace('_', ' ').title()}</small>
                 </div>
             """, unsafe_allow_html=True)
+        col_prev, col_page, col_next = st.columns([1, 1, 1])
+        with col_prev:
+            if st.button("◀ Previous", key="memory_prev",
+                         disabled=st.session_state.memory_page == 0):
+                st.session_state.memory_page -= 1
+                st.rerun()
+        with col_page:
+            st.caption(f"Page {st.session_state.memory_page + 1}")
+        with col_next:
+            if st.button("Next ▶", key="memory_next",
+                         disabled=not more):
+                st.session_state.memory_page += 1
+                st.rerun()
     else:
         st.info("No translations saved in memory yet. Approve good translations to build memory!")
     
@@ -496,14 +482,20 @@ with col2:
         for item in st.session_state.history:
             method_tag = {
                 "memory": "memory-tag",
+                "fuzzy-memory": "memory-tag",
                 "rule-based": "rule-tag",
-                "model-based": "model-tag"
+                "model-based": "model-tag",
+                "composed": "composed-tag",
+                "mixed": "mixed-tag"
             }.get(item['method'], "")
             
             method_label = {
                 "memory": "Memory",
+                "fuzzy-memory": "Memory~",
                 "rule-based": "Rule",
-                "model-based": "AI"
+                "model-based": "AI",
+                "composed": "Phrases",
+                "mixed": "Mixed"
             }.get(item['method'], "?")
             
             st.markdown(f"""
@@ -525,15 +517,15 @@ st.markdown("""
     <div class="row">
         <div class="col">
             <h4>1. Memory First</h4>
-            <p>The system first checks your approved translations in memory for an exact match.</p>
+            <p>The system first checks your approved translations in memory for an exact or near-identical match.</p>
         </div>
         <div class="col">
             <h4>2. Rule-Based Translation</h4>
-            <p>If no memory match, it applies predefined translation rules for common phrases.</p>
+            <p>If no memory match, it stitches together stored phrases found in the text, then applies predefined translation rules for common phrases.</p>
         </div>
         <div class="col">
             <h4>3. AI Model Translation</h4>
-            <p>For unmatched phrases, it uses advanced AI models for context-aware translation.</p>
+            <p>Sentences still unmatched are sent together to advanced AI models for context-aware translation.</p>
         </div>
         <div class="col">
             <h4>4. Continuous Improvement</h4>
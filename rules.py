@@ -0,0 +1,136 @@
+import re
+
+# Define translation rules
+# Keys are literal phrases, matched case-insensitively on whole words.
+translation_rules = {
+    "pidgin_to_english": {
+        'how far': 'how are you',
+        'abeg': 'please',
+        'na': 'is',
+        'you fit': 'can you',
+        'dey go': 'going',
+        'i': "I'm",
+        'i dey': "I am",
+        'wetin': 'what',
+        'wetin dey happen': 'what is happening',
+        'wetin happen': 'what happened',
+        'e don do': "that's enough",
+        'you sabi': 'do you know',
+        'sabi': 'know',
+        'they sabi': 'they know',
+        'he sabi': 'he know',
+        'she sabi': 'she know',
+        'i sabi sabi': 'I know very well',
+        'i no sabi': "I don't know",
+        'i no know': "I don't know",
+        'e be like say': 'it seems like',
+        'no wahala': 'no problem',
+        'you wan chop': 'do you want to eat',
+        'na dem': 'they are',
+        'make we go': "let's go",
+        'na wetin': 'that is what',
+        'una': 'you all',
+        'chai': 'oh no',
+        'popo': 'police',
+    },
+    "english_to_pidgin": {
+        'how are you': 'how far',
+        'please': 'abeg',
+        'is': 'na',
+        'can you': 'you fit',
+        'going': 'dey go',
+        "I'm": 'i',
+        'I am': 'i dey',
+        'what is happening': 'wetin dey happen',
+        'what happened': 'wetin happen',
+        'what': 'wetin',
+        "that's enough": 'e don do',
+        'do you know': 'you sabi',
+        'know': 'sabi',
+        'dont': 'no',
+        'they know': 'they sabi',
+        'he know': 'he sabi',
+        'she know': 'she sabi',
+        'i know': 'i sabi',
+        "I don't know": 'i no sabi',
+        'it seems like': 'e be like say',
+        'no problem': 'no wahala',
+        'do you want to eat': 'you wan chop',
+        'they are': 'na dem',
+        "let's go": 'make we go',
+        'that is what': 'na wetin',
+        'you all': 'una',
+        'oh no': 'chai',
+        'police': 'popo',
+    }
+}
+
+# Words, keeping inner apostrophes so "I'm" and "don't" stay one token
+TOKEN_RE = re.compile(r"\w+(?:'\w+)*")
+
+
+class PhraseRules:
+    """Rule table compiled into a token trie for single-pass longest-match replacement"""
+
+    def __init__(self, rules):
+        self.rules = {}
+        self.trie = {}
+        for phrase, replacement in dict(rules).items():
+            self.add(phrase, replacement)
+
+    def add(self, phrase, replacement):
+        """Add or replace one phrase"""
+        self.rules[phrase] = replacement
+        tokens = [t.lower() for t in TOKEN_RE.findall(phrase)]
+        if not tokens:
+            return
+        node = self.trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        # None is never a token, so it can mark the end of a phrase
+        node[None] = (phrase, replacement)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def matches(self, text):
+        """Return (start, end, phrase, replacement) for each leftmost-longest match"""
+        tokens = [(m.start(), m.end(), m.group().lower()) for m in TOKEN_RE.finditer(text)]
+        found = []
+        i = 0
+        while i < len(tokens):
+            node = self.trie.get(tokens[i][2])
+            best = None
+            j = i
+            while node is not None:
+                if None in node:
+                    best = (j, node[None])
+                j += 1
+                # Phrase words must be separated by whitespace only
+                if j >= len(tokens) or text[tokens[j - 1][1]:tokens[j][0]].strip():
+                    break
+                node = node.get(tokens[j][2])
+            if best is None:
+                i += 1
+                continue
+            j, (phrase, replacement) = best
+            found.append((tokens[i][0], tokens[j][1], phrase, replacement))
+            i = j + 1
+        return found
+
+    def apply(self, text):
+        """Apply the rules in one pass, returning the new text and the phrases that fired"""
+        pieces = []
+        fired = []
+        last = 0
+        for start, end, phrase, replacement in self.matches(text):
+            pieces.append(text[last:start])
+            pieces.append(replacement)
+            fired.append(phrase)
+            last = end
+        pieces.append(text[last:])
+        return "".join(pieces), fired
+
+
+# Compiled once per process
+rule_engines = {direction: PhraseRules(rules) for direction, rules in translation_rules.items()}
@@ -1,54 +1,71 @@
 import streamlit as st
-from transformers import T5Tokenizer, T5ForConditionalGeneration
+import os
+from model_cache import ModelOutputCache
+import metrics
+from cascade import split_segments
+from models import BACKEND, MODEL_IDS, PREFIXES, LazyModel, can_stream, generate_t5, load_t5, stream_t5
 
 # Initialize models and tokenizers
 @st.cache_resource
 def load_models():
-    # Pidgin to English model
-    pe_tokenizer = T5Tokenizer.from_pretrained("Xara2west/pidgin-to-english-translator-final09")
-    pe_model = T5ForConditionalGeneration.from_pretrained("Xara2west/pidgin-to-english-translator-final09")
-    
-    # English to Pidgin model
-    ep_tokenizer = T5Tokenizer.from_pretrained("Xara2west/pidgin-translator-final06")
-    ep_model = T5ForConditionalGeneration.from_pretrained("Xara2west/pidgin-translator-final06")
-    
+    # Each direction loads on first use and is freed after PIDEN_MODEL_IDLE_TIMEOUT
     return {
-        "pidgin_to_english": (pe_tokenizer, pe_model),
-        "english_to_pidgin": (ep_tokenizer, ep_model)
+        direction: LazyModel(lambda model_id=model_id: load_t5(model_id))
+        for direction, model_id in MODEL_IDS.items()
     }
 
 models = load_models()
 
-def translate(text, direction):
-    if direction == "Pidgin to English":
-        tokenizer, model = models["pidgin_to_english"]
-        prefix = "translate Pidgin to English: "
-    else:
-        tokenizer, model = models["english_to_pidgin"]
-        prefix = "translate English to Pidgin: "
-    
-    # Encode with task-specific prefix
-    inputs = tokenizer(
-        prefix + text,
-        return_tensors="pt",
-        max_length=512,
-        truncation=True,
-        padding="max_length"
+@st.cache_resource
+def start_metrics():
+    # Exporters configured by PIDEN_METRICS_PORT / PIDEN_METRICS_FILE, once per process
+    metrics.start_from_env()
+    return True
+
+start_metrics()
+
+@st.cache_resource
+def load_model_cache():
+    # Model outputs shared by all sessions, persisted if PIDEN_MODEL_CACHE is set
+    return ModelOutputCache(
+        capacity=int(os.environ.get("PIDEN_MODEL_CACHE_SIZE", "10000")),
+        path=os.environ.get("PIDEN_MODEL_CACHE")
     )
-    
-    # Generate translation with increased max_length
-    outputs = model.generate(
-        input_ids=inputs.input_ids,
-        attention_mask=inputs.attention_mask,
-        max_length=512,
-        num_beams=5,
-        early_stopping=True,
-        repetition_penalty=2.5,
-        length_penalty=1.0,
-        no_repeat_ngram_size=3
+
+def generate_batch(texts, key, profile="quality", batch_size=16, max_length=512):
+    """Run the model over texts, batching inputs of similar length together"""
+    tokenizer, model = models[key].get()
+    with metrics.TIER_LATENCY.time(tier="model-based"):
+        return generate_t5(tokenizer, model, PREFIXES[key], texts, profile,
+                           batch_size=batch_size, max_length=max_length)
+
+def translate_batch(texts, direction, profile="quality", batch_size=16, max_length=512):
+    """Translate a list of texts, reusing cached model outputs"""
+    key = "pidgin_to_english" if direction == "Pidgin to English" else "english_to_pidgin"
+    params = {"profile": profile, "max_length": max_length, "backend": BACKEND}
+    return load_model_cache().translate(
+        key, MODEL_IDS[key], params, texts,
+        lambda missing: generate_batch(missing, key, profile, batch_size, max_length)
     )
-    
-    return tokenizer.decode(outputs[0], skip_special_tokens=True)
+
+def translate(text, direction, profile="quality"):
+    return translate_batch([text], direction, profile)[0]
+
+def translate_streaming(text, direction, placeholder, profile="fast", max_length=512):
+    """Translate text, rendering the output into placeholder as it is decoded"""
+    key = "pidgin_to_english" if direction == "Pidgin to English" else "english_to_pidgin"
+    params = {"profile": profile, "max_length": max_length, "backend": BACKEND}
+
+    def stream(missing):
+        tokenizer, model = models[key].get()
+        result = ""
+        with metrics.TIER_LATENCY.time(tier="model-based"):
+            for result in stream_t5(tokenizer, model, PREFIXES[key], missing[0], profile, max_length):
+                placeholder.success(result + " ▌")
+        return [result]
+
+    # Shares the output with any other session translating the same text
+    return load_model_cache().translate(key, MODEL_IDS[key], params, [text], stream)[0]
 
 # Streamlit UI
 st.title("🇳🇬 Pidgin-English Translator")
@@ -59,6 +76,8 @@ if 'full_sentence' not in st.session_state:
     st.session_state.full_sentence = ""
 if 'new_session' not in st.session_state:
     st.session_state.new_session = False
+if 'segment_cache' not in st.session_state:
+    st.session_state.segment_cache = {}
 
 # Translation direction
 direction = st.radio(
@@ -67,31 +86,62 @@ direction = st.radio(
     horizontal=True
 )
 
+# Decoding profile: cheaper profiles answer faster with somewhat rougher output
+profile = st.select_slider(
+    "Decoding:",
+    options=("fast", "balanced", "quality"),
+    value="quality"
+)
+
 # Input text - use a key that we can control
 text_input_key = "text_input_" + str(st.session_state.new_session)
 text = st.text_area("Enter text to translate:", height=150, key=text_input_key)
 
 col1, col2 = st.columns(2)
 
+def translate_passage(text, direction, profile, result_box):
+    """Translate only the segments of text not translated before, then reassemble it"""
+    segment_cache = st.session_state.segment_cache
+    segments = split_segments(text)
+    missing = []
+    for _, segment, _ in segments:
+        if segment and (direction, profile, segment) not in segment_cache and segment not in missing:
+            missing.append(segment)
+    
+    if len(missing) == 1 and can_stream(profile):
+        # Greedy decoding shows words as soon as they are produced
+        results = [translate_streaming(missing[0], direction, result_box, profile)]
+    elif missing:
+        with st.spinner("Translating..."):
+            results = translate_batch(missing, direction, profile)
+    else:
+        results = []
+    for segment, result in zip(missing, results):
+        segment_cache[(direction, profile, segment)] = result
+    
+    passage = "".join(
+        lead + (segment_cache[(direction, profile, segment)] if segment else "") + trail
+        for lead, segment, trail in segments
+    )
+    return " ".join(results), passage.strip()
+
 with col1:
     if st.button("Translate"):
         if text.strip():
-            with st.spinner("Translating..."):
-                try:
-                    result = translate(text, direction)
-                    # Add to full sentence
-                    if st.session_state.full_sentence:
-                        st.session_state.full_sentence += " " + result
-                    else:
-                        st.session_state.full_sentence = result
-                    
-                    st.subheader("Current Translation:")
-                    st.success(result)
-                    
-                    st.subheader("Full Sentence:")
-                    st.info(st.session_state.full_sentence)
-                except Exception as e:
-                    st.error(f"Translation failed: {str(e)}")
+            try:
+                st.subheader("Current Translation:")
+                result_box = st.empty()
+                result, passage = translate_passage(text, direction, profile, result_box)
+                # Unchanged segments come from the cache, so only new text is shown here
+                result_box.success(result or "No new text since the last translation")
+                
+                # The full sentence is the whole passage, rebuilt from cached segments
+                st.session_state.full_sentence = passage
+                
+                st.subheader("Full Sentence:")
+                st.info(st.session_state.full_sentence)
+            except Exception as e:
+                st.error(f"Translation failed: {str(e)}")
         else:
             st.warning("Please enter text to translate")
 
@@ -99,6 +149,7 @@ with col2:
     if st.button("New Sentence"):
         # Clear the full sentence and trigger a new session
         st.session_state.full_sentence = ""
+        st.session_state.segment_cache = {}
         st.session_state.new_session = not st.session_state.new_session
         st.rerun()
 
@@ -0,0 +1,113 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+from concurrent import futures
+
+import metrics
+
+
+class SchedulerBusy(Exception):
+    """Raised when the inference queue is full"""
+
+
+class BatchScheduler:
+    """Collects model requests from many sessions and runs them as one batch
+
+    run_batch takes a list of texts, a decoding profile and whether every
+    request in the batch is background work, and returns their
+    translations. Requests arriving within max_wait seconds of each other
+    are merged, up to max_batch_size texts, into one call per profile.
+    Queued requests are taken lowest priority value first, so background
+    work (priority 1) only runs when no live request (priority 0) waits.
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait=0.01, max_queue=256):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.PriorityQueue(maxsize=max_queue)
+        # Keeps requests of equal priority in arrival order
+        self.sequence = itertools.count()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def submit(self, texts, profile="quality", timeout=None, priority=0, queued=None):
+        """Queue texts for translation and wait for the result
+
+        queued, if given, is called with the request's future once it is
+        queued, e.g. to promote it later.
+        """
+        future = futures.Future()
+        try:
+            self.queue.put_nowait((priority, next(self.sequence), list(texts), profile, future,
+                                   time.monotonic()))
+        except queue.Full:
+            raise SchedulerBusy("Translation queue is full, please try again shortly")
+        if queued is not None:
+            queued(future)
+        try:
+            return future.result(timeout=timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def promote(self, future):
+        """Move a queued background request up to live priority"""
+        with self.queue.mutex:
+            heap = self.queue.queue
+            for i, item in enumerate(heap):
+                if item[4] is future and item[0] > 0:
+                    heap[i] = (0,) + item[1:]
+                    heapq.heapify(heap)
+                    return True
+        return False
+
+    def _collect(self):
+        """Block for the first request, then gather more until the window or batch fills"""
+        batch = [self.queue.get()]
+        size = len(batch[0][2])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[2])
+        return batch
+
+    def _run(self):
+        while True:
+            # Callers that timed out have cancelled their futures; the rest
+            # are grouped so each model call uses a single decoding profile
+            batch = self._collect()
+            now = time.monotonic()
+            groups = {}
+            for item in batch:
+                if item[4].set_running_or_notify_cancel():
+                    metrics.MODEL_QUEUE_WAIT.observe(now - item[5])
+                    groups.setdefault(item[3], []).append(item)
+            for profile, batch in groups.items():
+                self._run_group(profile, batch)
+
+    def _run_group(self, profile, batch):
+        texts = [text for item in batch for text in item[2]]
+        metrics.MODEL_BATCH_SIZE.observe(len(texts))
+        try:
+            outputs = self.run_batch(texts, profile, all(item[0] > 0 for item in batch))
+        except Exception as e:
+            for item in batch:
+                item[4].set_exception(e)
+            return
+        start = 0
+        for _, _, item_texts, _, future, _ in batch:
+            future.set_result(outputs[start:start + len(item_texts)])
+            start += len(item_texts)
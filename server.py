@@ -0,0 +1,276 @@
+"""Headless HTTP API over the same memory -> rules -> model cascade as piden.py
+
+    python server.py --port 8080
+    python server.py --stub-model    # echoing stand-in for the models, no downloads
+
+Endpoints, with JSON bodies:
+
+    POST /translate        {"direction", "text", "profile"?}
+    POST /translate/batch  {"direction", "texts", "profile"?}
+    POST /approve          {"direction", "source", "translation"}
+    GET  /ready            200 once every model has loaded, 503 until then
+    GET  /metrics          Prometheus text format
+
+Connections are kept alive between requests. The cascade runs on a thread
+pool so a model call never blocks the event loop.
+"""
+import argparse
+import asyncio
+import json
+import sys
+from concurrent import futures
+
+import metrics
+from core import Translator
+from memory import MEM_FILE, check_pair
+from models import DECODING_PROFILES
+from scheduler import SchedulerBusy
+
+# Largest request body accepted, in bytes
+MAX_BODY = 1 << 20
+
+REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    408: "Request Timeout", 413: "Payload Too Large", 500: "Internal Server Error",
+    503: "Service Unavailable", 504: "Gateway Timeout",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class StubTranslator(Translator):
+    """Translator whose model tier echoes its input, for running the server without models"""
+
+    def __init__(self, **kwargs):
+        super().__init__(loader=lambda model_id: model_id, **kwargs)
+
+    def generate(self, direction, texts, profile, background=False):
+        self.models[direction].get(touch=not background)
+        return [f"[{direction}] {text}" for text in texts]
+
+
+class TranslationServer:
+    def __init__(self, translator, workers=8, request_timeout=60.0, idle_timeout=15.0):
+        self.translator = translator
+        self.executor = futures.ThreadPoolExecutor(workers, thread_name_prefix="translate")
+        self.request_timeout = request_timeout
+        self.idle_timeout = idle_timeout
+        self.routes = {
+            "/translate": ("POST", self.translate),
+            "/translate/batch": ("POST", self.translate_batch),
+            "/approve": ("POST", self.approve),
+            "/ready": ("GET", self.ready),
+            "/metrics": ("GET", self.metrics),
+        }
+
+    async def run_blocking(self, func, *args):
+        """Run func on the worker pool, giving up after the request timeout"""
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(self.executor, func, *args), self.request_timeout)
+
+    def fields(self, body, *names):
+        """The named fields of a request body, with direction and profile checked"""
+        values = []
+        for name in names:
+            if name not in body:
+                raise HTTPError(400, f"missing field: {name}")
+            values.append(body[name])
+        for name in ("direction", "profile"):
+            # Lists and objects would fail the lookups below as unhashable
+            if name in body and not isinstance(body[name], str):
+                raise HTTPError(400, f"{name} must be a string")
+        if "direction" in body and body["direction"] not in self.translator.model_ids:
+            raise HTTPError(400, f"unknown direction: {body['direction']}")
+        if body.get("profile", "quality") not in DECODING_PROFILES:
+            raise HTTPError(400, f"unknown profile: {body['profile']}")
+        return values
+
+    @staticmethod
+    def result(translated, method, segments):
+        return {
+            "translation": translated,
+            "method": method,
+            "segments": [{"source": src, "translation": tgt, "method": seg_method}
+                         for src, tgt, seg_method in segments],
+        }
+
+    async def translate(self, body):
+        direction, text = self.fields(body, "direction", "text")
+        if not isinstance(text, str):
+            raise HTTPError(400, "text must be a string")
+        translated, method, segments = await self.run_blocking(
+            lambda: self.translator.translate(direction, text, profile=body.get("profile", "quality")))
+        return 200, self.result(translated, method, segments)
+
+    async def translate_batch(self, body):
+        direction, texts = self.fields(body, "direction", "texts")
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            raise HTTPError(400, "texts must be a list of strings")
+        results = await self.run_blocking(
+            lambda: self.translator.translate_many(direction, texts, profile=body.get("profile", "quality")))
+        return 200, {"results": [self.result(*result) for result in results]}
+
+    async def approve(self, body):
+        direction, source, translation = self.fields(body, "direction", "source", "translation")
+        try:
+            check_pair(source, translation)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        saved = await self.run_blocking(self.translator.memory.save, direction, source, translation)
+        return 200, {"saved": saved}
+
+    async def ready(self, body):
+        # Models freed after PIDEN_MODEL_IDLE_TIMEOUT still count: they reload on
+        # the next request, which a 503 would stop from arriving
+        models = self.translator.ready()
+        return (200 if all(models.values()) else 503), {"ready": all(models.values()), "models": models}
+
+    async def metrics(self, body):
+        return 200, metrics.render()
+
+    async def dispatch(self, method, path, body):
+        route = self.routes.get(path.split("?")[0])
+        try:
+            if route is None:
+                raise HTTPError(404, f"no such endpoint: {path}")
+            if method != route[0]:
+                raise HTTPError(405, f"{path} only accepts {route[0]}")
+            if method == "POST":
+                try:
+                    body = json.loads(body or b"{}")
+                except ValueError:
+                    raise HTTPError(400, "request body is not valid JSON")
+                if not isinstance(body, dict):
+                    raise HTTPError(400, "request body must be a JSON object")
+            return await route[1](body)
+        except HTTPError as e:
+            return e.status, {"error": str(e)}
+        except SchedulerBusy as e:
+            return 503, {"error": str(e)}
+        except (asyncio.TimeoutError, futures.TimeoutError):
+            return 504, {"error": "translation timed out"}
+        except Exception as e:
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+    async def read_request(self, reader):
+        """Read one request, returning (method, path, headers, body) or None at end of stream"""
+        # Idle keep-alive connections are closed after idle_timeout
+        line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not line.strip():
+            return None
+        try:
+            return await self.read_rest(reader, line)
+        except asyncio.TimeoutError:
+            # The client started a request but was too slow to finish it
+            raise HTTPError(408, "timed out reading the request")
+
+    async def read_rest(self, reader, line):
+        """The rest of a request whose request line has been read"""
+        try:
+            method, path, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400, "malformed request line")
+        headers = {"version": version}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.request_timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if "transfer-encoding" in headers:
+            raise HTTPError(400, "chunked request bodies are not supported")
+        length = headers.get("content-length") or "0"
+        if not length.isdigit():
+            raise HTTPError(400, "malformed Content-Length")
+        length = int(length)
+        if length > MAX_BODY:
+            raise HTTPError(413, f"request body over {MAX_BODY} bytes")
+        body = await asyncio.wait_for(reader.readexactly(length), self.request_timeout)
+        return method, path, headers, body
+
+    async def respond(self, writer, status, payload, keep_alive):
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            body, content_type = json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json"
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        """Serve requests on one connection until the client or a timeout closes it"""
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except HTTPError as e:
+                    await self.respond(writer, e.status, {"error": str(e)}, False)
+                    break
+                except asyncio.TimeoutError:
+                    # Idle between requests, so close without a response
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                connection = headers.get("connection", "").lower()
+                if headers["version"] == "HTTP/1.0":
+                    keep_alive = connection == "keep-alive"
+                else:
+                    keep_alive = connection != "close"
+                status, payload = await self.dispatch(method, path, body)
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(server, host, port, preload=True):
+    listener = await asyncio.start_server(server.handle, host, port)
+    if preload:
+        # /ready turns 200 once this finishes
+        asyncio.get_running_loop().run_in_executor(server.executor, server.translator.load_models)
+    print(f"Serving on http://{host}:{port}", file=sys.stderr)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--memory", default=MEM_FILE, help="translation memory file")
+    parser.add_argument("--workers", type=int, default=8, help="threads running the cascade")
+    parser.add_argument("--request-timeout", type=float, default=60.0,
+                        help="seconds to read a request and to translate it")
+    parser.add_argument("--idle-timeout", type=float, default=15.0,
+                        help="seconds an idle keep-alive connection stays open")
+    parser.add_argument("--stub-model", action="store_true",
+                        help="echo inputs instead of loading the models, for local testing")
+    parser.add_argument("--no-preload", action="store_true",
+                        help="load the models on the first request instead of at startup")
+    args = parser.parse_args(argv)
+
+    if args.stub_model:
+        translator = StubTranslator(memory_path=args.memory)
+    else:
+        translator = Translator.from_env(memory_path=args.memory)
+    server = TranslationServer(translator, args.workers, args.request_timeout, args.idle_timeout)
+    try:
+        asyncio.run(serve(server, args.host, args.port, preload=not args.no_preload))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import threading
+from concurrent import futures
+
+
+class SpeculationSkipped(Exception):
+    """Raised inside a speculative job that gave way to live requests"""
+
+
+class Speculation:
+    """Background candidates for one input, keyed by the method they replace"""
+
+    def __init__(self):
+        self.futures = {}
+        self.cancelled = threading.Event()
+        # Keys the user has asked for, whose work no longer yields to live requests
+        self.wanted = set()
+        self.promotions = {}
+        self.lock = threading.Lock()
+
+    def track(self, key, promote):
+        """Record how to promote a queued request of key's job, promoting it now if key is wanted"""
+        with self.lock:
+            self.promotions.setdefault(key, []).append(promote)
+            wanted = key in self.wanted
+        if wanted:
+            promote()
+
+    def is_wanted(self, key):
+        with self.lock:
+            return key in self.wanted
+
+    def _want(self, key):
+        with self.lock:
+            self.wanted.add(key)
+            promotions = list(self.promotions.get(key, ()))
+        for promote in promotions:
+            promote()
+
+    def cancel(self):
+        """Drop the candidates, e.g. because the input changed"""
+        self.cancelled.set()
+        for future in self.futures.values():
+            future.cancel()
+
+    def result(self, key):
+        """The candidate for key, waiting only if it is already being computed
+
+        Returns None when there is no usable candidate and the caller should
+        compute it itself.
+        """
+        future = self.futures.get(key)
+        if future is None:
+            return None
+        if not future.running() and not future.done() and future.cancel():
+            # Still queued behind other work, so not worth waiting for
+            return None
+        # Already running: the user is waiting on it now, so it stops
+        # waiting behind live requests
+        self._want(key)
+        try:
+            return future.result()
+        except (SpeculationSkipped, futures.CancelledError):
+            return None
+        except Exception:
+            # Let the caller's own attempt surface the error
+            return None
+
+
+class Speculator:
+    """Small thread pool for work the user may ask for next
+
+    At most max_pending jobs are queued or running across every session;
+    beyond that new speculations are dropped rather than queued, so the
+    pool never builds a backlog.
+    """
+
+    def __init__(self, max_workers=2, max_pending=8):
+        self.pool = futures.ThreadPoolExecutor(max_workers=max_workers,
+                                               thread_name_prefix="speculate")
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def start(self, jobs):
+        """Run each of jobs, a dict of key -> func(speculation), in the background"""
+        speculation = Speculation()
+        for key, job in jobs.items():
+            with self.lock:
+                if self.pending >= self.max_pending:
+                    break
+                self.pending += 1
+            future = self.pool.submit(self._run, speculation, job)
+            future.add_done_callback(self._done)
+            speculation.futures[key] = future
+        return speculation
+
+    def _run(self, speculation, job):
+        if speculation.cancelled.is_set():
+            raise SpeculationSkipped()
+        return job(speculation)
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1